@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import intervals
+
+
+def generate(num, seed):
+    rnd = random.Random(seed)
+    starts = []
+    ends = []
+    t = 0.0
+    for _ in range(num):
+        # Mostly sequential lines with some overlapping typesetting
+        t += rnd.uniform(0.0, 4.0)
+        start = t - rnd.uniform(0.0, 3.0) if rnd.random() < 0.2 else t
+        starts.append(max(start, 0))
+        ends.append(start + rnd.uniform(0.5, 6.0))
+    order = list(range(num))
+    rnd.shuffle(order)
+    return [starts[i] for i in order], [ends[i] for i in order]
+
+
+def merge_legacy(starts, ends, join_secs):
+    parts = sorted(zip(starts, ends))
+    i = 1
+    while i < len(parts):
+        delta = parts[i][0] - parts[i-1][1]
+        if delta <= join_secs:
+            parts[i-1] = (parts[i-1][0], parts[i][1])
+            del parts[i]
+        else:
+            i += 1
+    return parts
+
+
+def bench(name, func, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    print(F'{name:8s} {best*1000:10.2f} ms  {len(result)} parts')
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the subtitle interval merging')
+    parser.add_argument('-n', '--num', type=int, default=100000, help='number of subtitle lines')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--join', type=float, default=2.0)
+    parser.add_argument('--pre-pad', type=float, default=0.25)
+    parser.add_argument('--post-pad', type=float, default=0.25)
+    parser.add_argument('--legacy', action='store_true', help='also time the old list-delete loop')
+    args = parser.parse_args(argv)
+
+    starts, ends = generate(args.num, args.seed)
+    merge = lambda: intervals.merge(starts, ends, args.join, args.pre_pad, args.post_pad)
+
+    print(F'{args.num} lines')
+
+    intervals.numpy_min_size = float('inf')
+    result = bench('python', merge, args.repeat)
+
+    if intervals.load_numpy() is not None:
+        intervals.numpy_min_size = 0
+        result_numpy = bench('numpy', merge, args.repeat)
+        if result_numpy != result:
+            print('numpy result differs from python result')
+            return 1
+
+    if args.legacy:
+        bench('legacy', lambda: merge_legacy(starts, ends, args.join), 1)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ffmpeg
+import pipeline
+import subtitles
+import intervals
+
+
+def generate_media(path, duration, source, video):
+    if source == 'silence':
+        audio = F'anullsrc=r=48000:cl=stereo:d={duration}'
+    else:
+        audio = F'sine=f=440:r=48000:d={duration}'
+
+    args = ['-loglevel', 'error', '-f', 'lavfi', '-i', audio]
+    if video:
+        args += ['-f', 'lavfi', '-i', F'testsrc=s=320x240:r=10:d={duration}', '-c:v', 'mpeg4']
+    args += ['-c:a', 'aac', '-shortest', '-y', path]
+
+    ffmpeg.check_call(*args)
+
+
+def generate_album_art(path):
+    ffmpeg.check_call('-loglevel', 'error', '-f', 'lavfi', '-i', 'color=c=teal:s=500x500', '-frames:v', '1', '-y', path)
+
+
+def generate_subtitles(path, num_cues, duration, seed):
+    rnd = random.Random(seed)
+    step = duration / max(num_cues, 1)
+
+    def srt_time(secs):
+        return subtitles.secs_to_strtime(secs).replace('.', ',')
+
+    def ass_time(secs):
+        return subtitles.secs_to_strtime(secs)[:-1]
+
+    f = open(path, 'w', encoding='utf-8')
+
+    if path.endswith('.ass'):
+        f.write('[Script Info]\nScriptType: v4.00+\n\n[Events]\n')
+        f.write('Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n')
+
+    for i in range(num_cues):
+        start = i * step + rnd.uniform(0, step * 0.3)
+        end = min(start + rnd.uniform(step * 0.2, step * 0.7), duration)
+        if path.endswith('.ass'):
+            f.write(F'Dialogue: 0,{ass_time(start)},{ass_time(end)},Default,,0,0,0,,Line {i}\n')
+        else:
+            f.write(F'{i+1}\n{srt_time(start)} --> {srt_time(end)}\nLine {i}\n\n')
+
+    f.close()
+
+
+def timed(stages, name, func):
+    t = time.perf_counter()
+    result = func()
+    stages[name] = time.perf_counter() - t
+    print(F'{name:24s} {stages[name]:10.3f} s', file=sys.stderr)
+    return result
+
+
+def ffmpeg_version():
+    try:
+        output = subprocess.check_output([ffmpeg._ffmpeg, '-version'], stdin=subprocess.DEVNULL)
+        return output.decode('utf-8', 'replace').splitlines()[0]
+    except Exception:
+        return None
+
+
+def run(args, work_path):
+    stages = {}
+
+    media_file = os.path.join(work_path, 'media.mkv' if args.video else 'media.m4a')
+    subtitle_file = os.path.join(work_path, 'media.' + args.subtitle_format)
+    album_art = os.path.join(work_path, 'art.png')
+
+    timed(stages, 'generate', lambda: (generate_media(media_file, args.duration, args.source, args.video),
+                                       generate_subtitles(subtitle_file, args.cues, args.duration, args.seed),
+                                       generate_album_art(album_art)))
+
+    timed(stages, 'parse', lambda: subtitles.parse_file(subtitle_file, use_cache=False))
+    subtitles.parse_file(subtitle_file)
+    cues = timed(stages, 'parse_cached', lambda: subtitles.parse_file(subtitle_file))
+
+    parts = timed(stages, 'merge', lambda: intervals.merge(cues.starts, cues.ends, args.join, args.pre_pad, args.post_pad))
+
+    options = pipeline.Options(args.join, args.pre_pad, args.post_pad, part_workers=args.part_workers, bitrate=args.bitrate)
+    report = pipeline.NullReport()
+
+    # Tags and album art are written by the final pass of every mode
+    checked_album_art = timed(stages, 'check_album_art', lambda: pipeline.check_album_art(album_art))
+    tags = pipeline.Tags('Benchmark', 1, 'Benchmark', checked_album_art)
+
+    for mode in args.modes:
+        if mode == 'pcm_cache':
+            try:
+                import numpy
+            except ImportError:
+                print('skipping pcm_cache, numpy is not installed', file=sys.stderr)
+                continue
+
+        with tempfile.TemporaryDirectory('iat') as tmp_path:
+            job = pipeline.Job(media_file, subtitle_file, os.path.join(work_path, F'out_{mode}.{args.format}'))
+
+            if mode == 'parts':
+                # Split up so the part encodes and the concat show up separately
+                codec_args = pipeline.encoder_args(job.output_file, options)
+                part_extension = pipeline.output_profile(job.output_file).part_extension
+                part_out_paths = timed(stages, 'parts.encode', lambda: pipeline.encode_parts(job, parts, options, tmp_path, report, codec_args, part_extension))
+                timed(stages, 'parts.concat', lambda: pipeline.concat_parts(part_out_paths, tmp_path, job.output_file, tags))
+                stages['parts'] = stages['parts.encode'] + stages['parts.concat']
+                stages['parts.per_part'] = stages['parts.encode'] / max(len(parts), 1)
+            else:
+                if mode == 'pcm_cache':
+                    timed(stages, 'pcm_cache.cold', lambda: pipeline.extractors[mode](job, parts, options, tmp_path, report, tags))
+                timed(stages, mode, lambda: pipeline.extractors[mode](job, parts, options, tmp_path, report, tags))
+
+    return {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ffmpeg': ffmpeg_version(),
+        },
+        'num_cues': len(cues),
+        'num_parts': len(parts),
+        'stages': stages,
+    }
+
+
+def compare(report, old_report):
+    print(F'{"stage":24s} {"old":>10s} {"new":>10s} {"speedup":>8s}')
+    for (name, new) in report['stages'].items():
+        old = old_report['stages'].get(name)
+        if old is None:
+            print(F'{name:24s} {"-":>10s} {new:10.3f}')
+        else:
+            print(F'{name:24s} {old:10.3f} {new:10.3f} {old / new if new else 0:7.2f}x')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the conversion pipeline stages on generated media')
+    parser.add_argument('--duration', type=float, default=600, help='media duration in seconds')
+    parser.add_argument('--cues', type=int, default=300, help='number of subtitle lines')
+    parser.add_argument('--subtitle-format', choices=list(subtitles.parsers.keys()), default='srt')
+    parser.add_argument('--source', choices=['sine', 'silence'], default='sine')
+    parser.add_argument('--video', action='store_true', help='add a video stream to the media file')
+    parser.add_argument('--modes', type=lambda s: s.split(','), default=list(pipeline.extractors.keys()),
+                        help='comma separated extraction modes (default: all)')
+    parser.add_argument('--format', choices=[e[1:] for e in pipeline.output_profiles.keys()], default='mp3', help='output format')
+    parser.add_argument('--bitrate', type=int, default=None, help='output bitrate in kbit/s (default: the format default)')
+    parser.add_argument('--join', type=float, default=1.0)
+    parser.add_argument('--pre-pad', type=float, default=0.2)
+    parser.add_argument('--post-pad', type=float, default=0.2)
+    parser.add_argument('--part-workers', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ffmpeg', default=os.environ.get('IAT_FFMPEG', 'ffmpeg'))
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    parser.add_argument('--compare', help='JSON report of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    for mode in args.modes:
+        if mode not in pipeline.extractors:
+            parser.error(F'unknown extraction mode {mode}')
+
+    if not ffmpeg.init(args.ffmpeg):
+        print('ffmpeg was not found', file=sys.stderr)
+        return 1
+
+    with tempfile.TemporaryDirectory('iat-bench') as work_path:
+        # Keep the caches of the benchmark away from the real ones
+        os.environ['XDG_CACHE_HOME'] = os.environ['LOCALAPPDATA'] = os.path.join(work_path, 'cache')
+        report = run(args, work_path)
+
+    report_json = json.dumps(report, indent=2)
+
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(report_json + '\n')
+        f.close()
+    else:
+        print(report_json)
+
+    if args.compare:
+        f = open(args.compare, 'r')
+        old_report = json.load(f)
+        f.close()
+        compare(report, old_report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Runs in a fresh interpreter, times are seconds since the parent started it
+CHILD_SCRIPT = r'''
+import sys, time, json
+t0 = float(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+marks = {'interpreter': time.time() - t0}
+
+import iat
+marks['import'] = time.time() - t0
+
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv[:1])
+window = iat.MainWindow()
+window.show()
+app.processEvents()
+marks['window'] = time.time() - t0
+
+def on_checked(ok, error):
+    marks['ffmpeg_check'] = time.time() - t0
+    marks['ffmpeg_ok'] = ok
+
+check = iat.FFmpegCheck_Thread(sys.argv[3])
+check.checked.connect(on_checked)
+check.finished.connect(app.quit)
+check.start()
+app.exec_()
+marks['preload'] = time.time() - t0
+
+print(json.dumps(marks))
+'''
+
+
+def run_once(args, env):
+    output = subprocess.check_output([sys.executable, '-c', CHILD_SCRIPT, repr(time.time()), repo_path, args.ffmpeg], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run(args, cache_path):
+    env = dict(os.environ)
+    env['QT_QPA_PLATFORM'] = args.platform
+    # A fresh cache, so the first run shows the ffmpeg check without a cached result
+    env['XDG_CACHE_HOME'] = env['LOCALAPPDATA'] = cache_path
+
+    cold = run_once(args, env)
+    if not cold['ffmpeg_ok']:
+        raise RuntimeError('ffmpeg was not found')
+
+    runs = [run_once(args, env) for i in range(args.runs)]
+
+    stages = {}
+    for name in ('interpreter', 'import', 'window', 'ffmpeg_check', 'preload'):
+        stages[name] = statistics.median(r[name] for r in runs)
+        print(F'{name:24s} {stages[name]:10.3f} s', file=sys.stderr)
+    stages['ffmpeg_check.cold'] = cold['ffmpeg_check']
+    print(F'{"ffmpeg_check.cold":24s} {stages["ffmpeg_check.cold"]:10.3f} s', file=sys.stderr)
+
+    return {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'stages': stages,
+    }
+
+
+def compare(report, old_report):
+    print(F'{"stage":24s} {"old":>10s} {"new":>10s} {"speedup":>8s}')
+    for (name, new) in report['stages'].items():
+        old = old_report['stages'].get(name)
+        if old is None:
+            print(F'{name:24s} {"-":>10s} {new:10.3f}')
+        else:
+            print(F'{name:24s} {old:10.3f} {new:10.3f} {old / new if new else 0:7.2f}x')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the GUI startup, all times are seconds since the process started')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='number of warm starts, the median is reported')
+    parser.add_argument('--platform', default='offscreen', help='Qt platform plugin (default: offscreen, no display needed)')
+    parser.add_argument('--ffmpeg', default=os.environ.get('IAT_FFMPEG', 'ffmpeg'))
+    parser.add_argument('-o', '--output', help='write the JSON report to this file')
+    parser.add_argument('--compare', help='JSON report of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory('iat-bench') as cache_path:
+        try:
+            report = run(args, cache_path)
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            print(e, file=sys.stderr)
+            return 1
+
+    report_json = json.dumps(report, indent=2)
+
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(report_json + '\n')
+        f.close()
+    else:
+        print(report_json)
+
+    if args.compare:
+        f = open(args.compare, 'r')
+        old_report = json.load(f)
+        f.close()
+        compare(report, old_report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
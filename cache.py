@@ -0,0 +1,56 @@
+import os
+import hashlib
+
+
+def root_dir():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'ImmersionAudioTool')
+
+
+def cache_dir(name):
+    path = os.path.join(root_dir(), name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_key(path, *extra):
+    st = os.stat(path)
+    key = '\0'.join([os.path.abspath(path), str(st.st_size), str(st.st_mtime_ns)] + [str(e) for e in extra])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def evict(dir_path, max_bytes, keep=()):
+    # Least recently used entries go first, entries are touched on every hit
+    entries = []
+    total = 0
+
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+    entries.sort()
+
+    for (mtime, size, path) in entries:
+        if total <= max_bytes:
+            break
+        if os.path.splitext(os.path.basename(path))[0] in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
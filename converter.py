@@ -1,124 +1,30 @@
-import os
-from collections import namedtuple
-import tempfile
-import subprocess
-import eyed3
+import time
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
 import subtitles
-import ffmpeg
-
-
-Job = namedtuple('Job', 'media_file subtitle_file output_file')
-Options = namedtuple('Options', 'join_secs pre_pad post_pad')
-Metadata = namedtuple('Metadata', 'album album_art')
+import pipeline
 
 
 class ConverterThread(QThread):
 
     progress_update = pyqtSignal(object)
+    event = pyqtSignal(object)
 
     def __init__(self, jobs, options, metadata, parent=None):
         super(ConverterThread, self).__init__(parent)
         self.jobs = jobs
-        self.options = options
-        self.metadata = metadata
-
-    def run(self):
+        self.errors = []
+        self.converter = pipeline.Converter(jobs, options, metadata, self.progress_update.emit, self.on_event)
 
-        num_jobs = len(self.jobs)
+    def on_event(self, e):
+        if e['event'] == 'part':
+            print(F'[{e["job"]}/{len(self.jobs)}] ({e["done"]}/{e["parts"]}) {subtitles.secs_to_strtime(e["start"])} {subtitles.secs_to_strtime(e["end"])}')
+        self.event.emit(e)
 
-        album_art_data = None
-        album_art_mime = None
-        
-        if self.metadata.album_art is not None:
-            img_mime_types = {
-                'png':  'image/png',
-                'jpeg': 'image/jpeg',
-                'jpg':  'image/jpeg',
-            }
-
-            extension_i = self.metadata.album_art.rfind('.')
-
-            if extension_i > 0:
-                extension = self.metadata.album_art[extension_i+1:].lower()
-                if extension in img_mime_types:
-                    album_art_file = open(self.metadata.album_art, 'rb')
-                    album_art_data = album_art_file.read()
-                    album_art_file.close()
-                    album_art_mime = img_mime_types[extension]
-
-        for job_idx, job in enumerate(self.jobs):
-            with tempfile.TemporaryDirectory('iat') as tmp_path:
-                subs = subtitles.parse_file(job.subtitle_file)
-
-                parts = []
-
-                for s in subs:
-                    parts.append((s.start, s.end))    # todo: filter out useless stuff
-
-                i = 1
-                while i < len(parts):
-                    last_part = parts[i-1]
-                    curr_part = parts[i]
-
-                    delta = curr_part[0] - last_part[1]
-
-                    if delta <= self.options.join_secs:
-                        parts[i-1] = (last_part[0], curr_part[1])
-                        del parts[i]
-                    else:
-                        i += 1
-
-                part_list_path = os.path.join(tmp_path, 'part_list.txt')
-                part_list_f = open(part_list_path, 'w')
-
-                num_parts = len(parts)
-
-                for (i, (start, end)) in enumerate(parts):
-                    print(F'[{job_idx+1}/{num_jobs}] ({i+1}/{num_parts}) {subtitles.secs_to_strtime(start)} {subtitles.secs_to_strtime(end)}')
-
-                    progress = 0
-                    if job_idx > 0:
-                        progress += job_idx / num_jobs
-                    if i > 0:
-                        progress += i / num_parts / num_jobs
-                    self.progress_update.emit(progress)
-
-                    encode_start = max(start - self.options.pre_pad, 0)
-                    encode_end = end-start + self.options.pre_pad + self.options.post_pad
-
-                    part_out_path = os.path.join(tmp_path, F'part{i}.mp3')
-
-                    ffmpeg.call('-loglevel', 'panic',
-                                '-ss', subtitles.secs_to_strtime(encode_start),
-                                '-i', job.media_file,
-                                '-t', subtitles.secs_to_strtime(encode_end),
-                                '-q:a', '0', '-map', 'a',
-                                part_out_path)
-                    
-                    part_list_f.write(F'file \'{part_out_path}\'\n')
-                
-                part_list_f.close()
-
-                ffmpeg.call('-loglevel', 'panic',
-                            '-f', 'concat', '-safe', '0',
-                            '-i', part_list_path,
-                            '-c', 'copy',
-                            '-y',
-                            job.output_file)
-
-                if os.path.isfile(job.output_file) and job.output_file.endswith('.mp3'):
-                    mp3file = eyed3.load(job.output_file)
-                    tag = mp3file.tag
-                    if self.metadata.album:
-                        tag.album = self.metadata.album
-                    if album_art_data is not None:
-                        tag.images.set(3, album_art_data, album_art_mime)
-                    tag.title = os.path.basename(job.output_file).replace('.mp3', '')
-                    tag.track_num = job_idx + 1
-                    tag.save()
+    def run(self):
+        self.converter.run()
+        self.errors = self.converter.errors
 
 
 
@@ -136,26 +42,72 @@ class ConvertWindow(QDialog):
         self.progress_bar.setMaximum(10000)
         self.lyt.addWidget(self.progress_bar)
 
+        self.status_label = QLabel()
+        self.lyt.addWidget(self.status_label)
+
+        self.start_time = time.perf_counter()
+        self.cancelling = False
+        self.progress = 0
+        self.audio_secs = 0
+        self.job_audio_secs = {}
+
         self.thread = ConverterThread(jobs, options, metadata, self)
         self.thread.progress_update.connect(self.on_progress_update)
+        self.thread.event.connect(self.on_event)
         self.thread.finished.connect(self.on_thread_done)
         self.thread.start()
 
     def on_thread_done(self):
         self.progress_bar.setValue(10000)
+
+        if self.thread.errors:
+            failed = '\n'.join(F'{job.media_file}: {e}' for (job, e) in self.thread.errors)
+            QMessageBox.warning(self, self.windowTitle(), 'The following conversions failed:\n\n' + failed)
+
         self.close()
 
     def on_progress_update(self, progress):
+        self.progress = progress
         self.progress_bar.setValue(int(10000 * progress))
+        self.update_status()
+
+    def on_event(self, e):
+        if e['event'] == 'part':
+            secs = e['end'] - e['start']
+            self.audio_secs += secs
+            self.job_audio_secs[e['job']] = self.job_audio_secs.get(e['job'], 0) + secs
+        elif e['event'] == 'job_end':
+            # Not every extraction mode reports its parts
+            self.audio_secs += e['audio_secs'] - self.job_audio_secs.pop(e['job'], 0)
+
+    def update_status(self):
+        if self.cancelling:
+            return
+
+        elapsed = time.perf_counter() - self.start_time
+        if self.progress <= 0 or elapsed <= 0:
+            return
+
+        eta = elapsed * (1 - self.progress) / self.progress
+        status = F'Remaining: {subtitles.secs_to_strtime(eta)[:-4]}'
+
+        if self.audio_secs > 0:
+            status += F'    Speed: {self.audio_secs / elapsed:.1f}x realtime'
+
+        self.status_label.setText(status)
 
     def closeEvent(self, evt):
         if self.thread.isFinished():
             evt.accept()
         else:
             evt.ignore()
-            self.ask_cancel()
+            if not self.cancelling:
+                self.ask_cancel()
 
     def ask_cancel(self):
         r = QMessageBox.warning(self, '', 'Do you really want to cancel the current conversions?', QMessageBox.Yes | QMessageBox.No)
-        if r == QMessageBox.Yes:
-            self.thread.terminate()
+        if r == QMessageBox.Yes and not self.thread.isFinished():
+            # The thread finishes once ffmpeg is stopped and the temp files are removed
+            self.cancelling = True
+            self.status_label.setText('Cancelling...')
+            self.thread.converter.cancel()
@@ -0,0 +1,135 @@
+import re
+from array import array
+
+
+# Rules are given as strings so they can be stored with the options:
+#   'style', 'style:REGEX'    ass style name (the built in one matches sign/song/karaoke styles)
+#   'effect', 'effect:REGEX'  ass effect field (the built in one matches any effect)
+#   'layer:N'                 ass lines on layer N or above
+#   'typeset', 'karaoke', 'drawing', 'bracketed', 'music'  built in text heuristics
+#   'regex:REGEX'             user regex searched in the raw line text
+#   'nonspeech'               all the built in rules above except layer
+
+NONSPEECH_RULES = ('style', 'effect', 'typeset', 'karaoke', 'drawing', 'bracketed', 'music')
+
+default_style_pattern = (r'(?i)(?<![a-z])(?:signs?|songs?|op|ed|opening|ending|insert|karaoke|kara|kfx|fx|'
+                         r'lyrics?|romaji|kanji|title|typeset|ts|notes?|captions?)(?![a-z])')
+
+default_effect_pattern = r'.'
+
+text_patterns = {
+    # Positioned or rotated lines are signs
+    'typeset': r'\{[^}]*\\(?:pos|move|org|i?clip)\(|\{[^}]*\\fr[xyz]?-?\d',
+    'karaoke': r'\{[^}]*\\[kK][fo]?\d',
+    'drawing': r'\{[^}]*\\p[1-9]',
+    # Lines made up only of [music], (laughs), notes and the like
+    'bracketed': r'\A(?:\s|\\[Nnh]|\{[^}]*\}|\[[^\]]*\]|\([^)]*\)|（[^）]*）|【[^】]*】|〔[^〕]*〕|[♪♫♬～~*#])*\Z',
+    'music': r'\A(?:\s|\{[^}]*\})*[♪♫♬]',
+}
+
+
+class CueFilter:
+    # Style, effect and layer rules are checked once per distinct name, the
+    # text rules are combined into one regex so most lines take a single search
+
+    def __init__(self, specs):
+        self.specs = tuple(specs)
+        self.name_rules = []     # (spec, 'style'/'effect', regex)
+        self.layer_rules = []    # (spec, min layer)
+        self.text_rules = []     # (spec, regex)
+
+        for spec in expand(self.specs):
+            kind, _, arg = spec.partition(':')
+            if kind in ('style', 'effect'):
+                default = default_style_pattern if kind == 'style' else default_effect_pattern
+                self.name_rules.append((spec, kind, compile_regex(spec, arg or default)))
+            elif kind == 'layer':
+                try:
+                    self.layer_rules.append((spec, int(arg)))
+                except ValueError:
+                    raise ValueError(F'{spec}: the layer must be a number') from None
+            elif kind == 'regex':
+                if not arg:
+                    raise ValueError(F'{spec}: empty regex')
+                self.text_rules.append((spec, compile_regex(spec, arg)))
+            elif kind in text_patterns and not arg:
+                self.text_rules.append((spec, compile_regex(spec, text_patterns[kind])))
+            else:
+                raise ValueError(F'Unknown cue filter rule: {spec}')
+
+        self.text_re = None
+        if self.text_rules and all(r.groups == 0 for (_, r) in self.text_rules):
+            try:
+                self.text_re = re.compile('|'.join(F'(?:{r.pattern})' for (_, r) in self.text_rules))
+            except re.error:
+                # Inline flags are only allowed at the start of a pattern
+                pass
+
+    def __bool__(self):
+        return bool(self.name_rules or self.layer_rules or self.text_rules)
+
+    def apply(self, cues):
+        # Returns the starts and ends of the kept cues and the seconds removed per rule
+        removed = {spec: 0.0 for spec in expand(self.specs)}
+
+        name_hits = [None] * len(cues.names)
+        for (name_id, name) in enumerate(cues.names):
+            if name:
+                name_hits[name_id] = {kind: spec for (spec, kind, r) in reversed(self.name_rules) if r.search(name)}
+
+        texts = cues.texts() if self.text_rules else None
+
+        starts = array('d')
+        ends = array('d')
+
+        for i in range(len(cues)):
+            rule = self.match(cues, i, name_hits, texts)
+            if rule is None:
+                starts.append(cues.starts[i])
+                ends.append(cues.ends[i])
+            else:
+                removed[rule] += max(cues.ends[i] - cues.starts[i], 0)
+
+        return starts, ends, removed
+
+    def match(self, cues, i, name_hits, texts):
+        for (spec, min_layer) in self.layer_rules:
+            if cues.layers[i] >= min_layer:
+                return spec
+
+        style_hits = name_hits[cues.style_ids[i]]
+        if style_hits and 'style' in style_hits:
+            return style_hits['style']
+        effect_hits = name_hits[cues.effect_ids[i]]
+        if effect_hits and 'effect' in effect_hits:
+            return effect_hits['effect']
+
+        if texts is not None:
+            text = texts[i]
+            if self.text_re is not None and not self.text_re.search(text):
+                return None
+            for (spec, r) in self.text_rules:
+                if r.search(text):
+                    return spec
+
+        return None
+
+
+def expand(specs):
+    expanded = []
+    for spec in specs:
+        for rule in (NONSPEECH_RULES if spec == 'nonspeech' else (spec,)):
+            if rule not in expanded:
+                expanded.append(rule)
+    return expanded
+
+
+def compile_regex(spec, pattern):
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError(F'{spec}: {e}') from None
+
+
+def compile(specs):
+    return CueFilter(specs)
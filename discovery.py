@@ -0,0 +1,199 @@
+import os
+import re
+from collections import namedtuple
+
+import subtitles
+
+
+# Patterns are paths that may contain any number of * and ? wildcards, which
+# stay inside one path component, and ** components matching any number of
+# directories. Each directory is listed once with os.scandir, the listings are
+# shared with the subtitle index so planning a batch does not stat every file.
+#
+# The fill of a match is the part of its path from the first to the last
+# wildcard, it replaces the * of the output path.
+
+Match = namedtuple('Match', 'path fill')
+
+_ignore_case = os.name == 'nt'
+
+# Language suffixes between the stem and the extension, e.g. ep01.ja.srt or ep01.pt-BR.ass
+_language_re = re.compile(r'[A-Za-z]{2,3}(?:[-_][A-Za-z0-9]{2,4})?')
+
+
+def natural_sort_key(text):
+    return [int(c) if c.isdigit() else c.lower() for c in re.split('([0-9]+)', text)]
+
+
+def natural_sort(l):
+    return sorted(l, key=natural_sort_key)
+
+
+def split_path(path):
+    return re.split(r'[\\/]', path)
+
+
+def has_wildcard(text):
+    return '*' in text or '?' in text
+
+
+class DirCache:
+
+    def __init__(self):
+        self.listings = {}
+
+    def listing(self, dir_path):
+        # Returns ([file names], [dir names]) of dir_path, empty if it can't be listed
+        dir_path = os.path.normpath(dir_path or '.')
+        listing = self.listings.get(dir_path)
+        if listing is None:
+            file_names = []
+            dir_names = []
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_file():
+                                file_names.append(entry.name)
+                            elif entry.is_dir():
+                                dir_names.append(entry.name)
+                        except OSError:
+                            continue
+            except OSError:
+                pass
+            listing = self.listings[dir_path] = (file_names, dir_names)
+        return listing
+
+
+def component_re(component):
+    pattern = ''.join('[^/]*' if c == '*' else '[^/]' if c == '?' else re.escape(c) for c in component)
+    return re.compile(pattern + r'\Z', re.I if _ignore_case else 0)
+
+
+def fill_regex(components):
+    # Matches a path relative to the pattern root, group 1 is the fill
+    tokens = []
+    for (i, component) in enumerate(components):
+        last = i == len(components) - 1
+        if component == '**':
+            tokens.append((True, '.*' if last else '(?:[^/]*/)*'))
+            continue
+        for c in component:
+            tokens.append((c in '*?', '[^/]*' if c == '*' else '[^/]' if c == '?' else re.escape(c)))
+        if not last:
+            tokens.append((False, '/'))
+
+    wildcards = [i for (i, (is_wildcard, _)) in enumerate(tokens) if is_wildcard]
+    first, last = wildcards[0], wildcards[-1] + 1
+    pattern = ''.join(t for (_, t) in tokens[:first]) + '(' + ''.join(t for (_, t) in tokens[first:last]) + ')' + ''.join(t for (_, t) in tokens[last:])
+    return re.compile(pattern + r'\Z', re.I if _ignore_case else 0)
+
+
+def find_files(pattern, dir_cache=None):
+    # Returns the Matches of pattern in natural order
+    dir_cache = dir_cache or DirCache()
+    components = split_path(pattern)
+
+    if not has_wildcard(pattern):
+        dir_path, file_name = os.path.split(pattern)
+        if file_name in dir_cache.listing(dir_path)[0] or os.path.isfile(pattern):
+            return [Match(pattern, os.path.splitext(file_name)[0])]
+        return []
+
+    # Start at the deepest directory without wildcards
+    root_len = 0
+    while root_len < len(components) - 1 and not has_wildcard(components[root_len]):
+        root_len += 1
+    root = re.match(r'(?:[^\\/]*[\\/]){%d}' % root_len, pattern).group(0)
+
+    rel_components = components[root_len:]
+    fill_re = fill_regex(rel_components)
+
+    matchers = [None if c == '**' else component_re(c) for c in rel_components]
+
+    matches = []
+
+    def walk(dir_path, rel_names, i):
+        # Matches the entries of dir_path against component i
+        file_names, dir_names = dir_cache.listing(dir_path)
+        matcher = matchers[i]
+        last = i == len(matchers) - 1
+
+        if matcher is None:
+            # ** matches this directory and everything below it
+            if last:
+                for name in file_names:
+                    add(dir_path, rel_names, name)
+            else:
+                walk(dir_path, rel_names, i + 1)
+            for name in dir_names:
+                walk(os.path.join(dir_path, name), rel_names + [name], i)
+            return
+
+        if last:
+            for name in file_names:
+                if matcher.match(name):
+                    add(dir_path, rel_names, name)
+        else:
+            for name in dir_names:
+                if matcher.match(name):
+                    walk(os.path.join(dir_path, name), rel_names + [name], i + 1)
+
+    def add(dir_path, rel_names, name):
+        fill = fill_re.match('/'.join(rel_names + [name])).group(1).strip('/')
+        matches.append(Match(os.path.join(dir_path, name), fill.replace('/', os.sep)))
+
+    walk(root, [], 0)
+
+    # Several ** can reach the same file
+    matches = list({m.path: m for m in matches}.values())
+    return sorted(matches, key=lambda m: natural_sort_key(m.path))
+
+
+class SubtitleIndex:
+    # Finds the subtitles next to media files by stem, with or without a
+    # language suffix. Exact stems win, then the languages in order of preference.
+
+    def __init__(self, dir_cache=None, languages=(), extensions=None):
+        self.dir_cache = dir_cache or DirCache()
+        self.languages = [l.lower() for l in languages]
+        self.extensions = list(extensions or subtitles.parsers.keys())
+        self.indexes = {}
+
+    def index(self, dir_path):
+        # {stem: [(rank, subtitle name)]} of one directory
+        index = self.indexes.get(dir_path)
+        if index is not None:
+            return index
+
+        index = {}
+        for name in self.dir_cache.listing(dir_path)[0]:
+            stem, extension = os.path.splitext(name)
+            extension = extension[1:].lower()
+            if extension not in self.extensions:
+                continue
+            extension_rank = self.extensions.index(extension)
+
+            key = stem.lower() if _ignore_case else stem
+            index.setdefault(key, []).append(((0, 0, extension_rank, ''), name))
+
+            base, dot, language = stem.rpartition('.')
+            if dot and _language_re.fullmatch(language):
+                language = language.lower()
+                language_rank = self.languages.index(language) if language in self.languages else len(self.languages)
+                key = base.lower() if _ignore_case else base
+                index.setdefault(key, []).append(((1, language_rank, extension_rank, language), name))
+
+        for candidates in index.values():
+            candidates.sort()
+
+        self.indexes[dir_path] = index
+        return index
+
+    def find(self, media_path):
+        dir_path, file_name = os.path.split(media_path)
+        stem = os.path.splitext(file_name)[0]
+        candidates = self.index(dir_path).get(stem.lower() if _ignore_case else stem)
+        if not candidates:
+            return None
+        return os.path.join(dir_path, candidates[0][1])
@@ -1,58 +1,259 @@
 import os
+import shutil
+import asyncio
+import threading
 import subprocess
-from PyQt5.QtCore import *
-from PyQt5.QtWidgets import *
+
+import cache
 
 
 _ffmpeg = None
 
+# Keep ffmpeg from opening a console window when running from a windowed build
+if os.name == 'nt':
+    _popen_kwargs = {'creationflags': subprocess.CREATE_NO_WINDOW}
+else:
+    _popen_kwargs = {}
 
-def try_ffmpeg_path(path):
-    try:
-        from subprocess import DEVNULL
-    except ImportError:
-        DEVNULL = os.open(os.devnull, os.O_RDWR)
+
+class FFmpegError(RuntimeError):
+
+    def __init__(self, returncode, stderr=''):
+        message = F'ffmpeg exited with code {returncode}'
+        stderr_lines = stderr.strip().splitlines()
+        if stderr_lines:
+            message += F': {stderr_lines[-1]}'
+        super(FFmpegError, self).__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class Cancelled(Exception):
+
+    def __init__(self):
+        super(Cancelled, self).__init__('Cancelled')
+
+
+def try_ffmpeg_path(path, on_error=None):
+    # A binary that passed the check is remembered by its path and mtime,
+    # so later starts don't have to run it
+    checked_path = checked_marker_path(path)
+    if checked_path is not None and os.path.isfile(checked_path):
+        return True
 
     try:
-        output = subprocess.check_output([path, '-version'], stdin=DEVNULL, stderr=DEVNULL)
+        output = subprocess.check_output([path, '-version'], stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **_popen_kwargs)
         if not output.startswith(b'ffmpeg'):
             return False
     except Exception as e:
-        QMessageBox.information(None, '', path + '\n\n' + str(e))
+        if on_error is not None:
+            on_error(path, e)
         return False
+
+    if checked_path is not None:
+        try:
+            open(checked_path, 'wb').close()
+        except OSError:
+            pass
+
     return True
 
 
-def init():
+def checked_marker_path(path):
+    try:
+        resolved = shutil.which(path)
+        if resolved is None:
+            return None
+        return os.path.join(cache.cache_dir('ffmpeg'), cache.file_key(os.path.realpath(resolved)) + '.ok')
+    except OSError:
+        return None
+
+
+def init(path='ffmpeg', on_error=None):
 
     global _ffmpeg
 
-    settings = QSettings()
-    path = settings.value('ffmpeg_path', 'ffmpeg')
+    if not try_ffmpeg_path(path, on_error):
+        return False
 
-    if try_ffmpeg_path(path):
-        _ffmpeg = path
-        return True
+    _ffmpeg = path
+    return True
+
+
+# Process manager
+#
+# ffmpeg runs on an asyncio loop in a background thread, which keeps at most
+# max_processes of them running at once no matter how many jobs and part
+# workers ask for one. The blocking functions below are called from the
+# worker threads. cancel() stops every running ffmpeg and makes new ones raise
+# Cancelled until reset(), so workers unwind through their normal cleanup.
+
+KILL_TIMEOUT = 5.0
+STDERR_MAX_BYTES = 64 * 1024
+
+
+class ProcessManager:
+
+    def __init__(self, max_processes=None):
+        self.max_processes = max_processes or 2 * (os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        self.loop = None
+        self.semaphore = None
+        self.running = set()    # asyncio processes, only touched from the loop
+        self.popens = set()     # streaming processes started with popen()
+        self.cancelled = False
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='ffmpeg-processes', daemon=True).start()
+            return self.loop
+
+    def run(self, args, progress_cb=None):
+        # Returns (returncode, stderr). progress_cb gets the output position in
+        # seconds and is called from the loop thread.
+        if self.cancelled:
+            raise Cancelled()
+        return asyncio.run_coroutine_threadsafe(self.run_async(args, progress_cb), self.get_loop()).result()
+
+    async def run_async(self, args, progress_cb=None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_processes)
+
+        async with self.semaphore:
+            if self.cancelled:
+                raise Cancelled()
+
+            if progress_cb is not None:
+                args = [args[0], '-progress', 'pipe:1', '-nostats'] + list(args[1:])
+
+            proc = await asyncio.create_subprocess_exec(*args,
+                                                        stdin=subprocess.DEVNULL,
+                                                        stdout=subprocess.PIPE if progress_cb is not None else subprocess.DEVNULL,
+                                                        stderr=subprocess.PIPE,
+                                                        **_popen_kwargs)
+            self.running.add(proc)
+            try:
+                if progress_cb is not None:
+                    _, stderr = await asyncio.gather(read_progress(proc.stdout, progress_cb), read_tail(proc.stderr))
+                else:
+                    stderr = await read_tail(proc.stderr)
+                returncode = await proc.wait()
+            finally:
+                self.running.discard(proc)
+
+        if self.cancelled:
+            raise Cancelled()
+
+        return returncode, stderr.decode('utf-8', 'replace')
+
+    def popen(self, args, **kwargs):
+        # For processes the caller streams data through. These are not counted
+        # against max_processes, but are stopped by cancel() all the same.
+        if self.cancelled:
+            raise Cancelled()
+
+        proc = subprocess.Popen(args, **_popen_kwargs, **kwargs)
+
+        with self.lock:
+            self.popens = {p for p in self.popens if p.poll() is None}
+            self.popens.add(proc)
+            cancelled = self.cancelled
 
+        if cancelled:
+            proc.kill()
+            proc.wait()
+            raise Cancelled()
+
+        return proc
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            popens = list(self.popens)
+            loop = self.loop
+
+        popens = [proc for proc in popens if proc.poll() is None]
+        for proc in popens:
+            proc.terminate()
+        if popens:
+            timer = threading.Timer(KILL_TIMEOUT, kill_remaining, (popens,))
+            timer.daemon = True
+            timer.start()
+
+        if loop is not None:
+            loop.call_soon_threadsafe(self.terminate_running)
+
+    def terminate_running(self):
+        procs = list(self.running)
+        for proc in procs:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+        self.loop.call_later(KILL_TIMEOUT, kill_remaining, procs)
+
+    def reset(self):
+        with self.lock:
+            self.cancelled = False
+
+
+def kill_remaining(procs):
+    for proc in procs:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def read_progress(stream, progress_cb):
+    # -progress writes key=value lines, out_time_us is the output position
+    async for line in stream:
+        if line.startswith(b'out_time_us='):
+            try:
+                progress_cb(int(line[12:]) / 1000000)
+            except ValueError:
+                pass
+
+
+async def read_tail(stream):
+    tail = b''
     while True:
-        r = QMessageBox.information(None, '', 'ffmpeg was not found. Please select a path to ffmpeg.', QMessageBox.Ok | QMessageBox.Cancel)
-        if r != QMessageBox.Ok:
-            return False
+        data = await stream.read(STDERR_MAX_BYTES)
+        if not data:
+            return tail
+        tail = (tail + data)[-STDERR_MAX_BYTES:]
 
-        path = QFileDialog.getOpenFileName(None, 'Select ffmpeg')[0]
-        if not path:
-            return False
 
-        if not try_ffmpeg_path(path):
-            continue
-        
-        _ffmpeg = path
-        settings.setValue('ffmpeg_path', path)
+class StderrTail:
+    # Drains the stderr pipe of a popen() process in a thread so it can't
+    # block, and keeps its end for FFmpegError
+
+    def __init__(self, stream):
+        self.tail = b''
+        self.thread = threading.Thread(target=self.read, args=(stream,), name='ffmpeg-stderr', daemon=True)
+        self.thread.start()
+
+    def read(self, stream):
+        try:
+            for data in iter(lambda: stream.read(STDERR_MAX_BYTES), b''):
+                self.tail = (self.tail + data)[-STDERR_MAX_BYTES:]
+        except (OSError, ValueError):
+            pass
+        finally:
+            stream.close()
+
+    def text(self):
+        # Only complete once the process has exited
+        self.thread.join()
+        return self.tail.decode('utf-8', 'replace')
 
-        return True
 
+processes = ProcessManager()
 
-def call(*args):
+
+def call(*args, progress_cb=None):
 
     global _ffmpeg
 
@@ -61,4 +262,36 @@ def call(*args):
 
     call_args = [_ffmpeg] + list(args)
 
-    return subprocess.call(call_args, shell=True)
+    return processes.run(call_args, progress_cb)[0]
+
+
+def check_call(*args, progress_cb=None):
+    # Returns the end of stderr, analysis filters write their results there
+    if _ffmpeg is None:
+        raise FFmpegError(-1)
+
+    returncode, stderr = processes.run([_ffmpeg] + list(args), progress_cb)
+    if returncode != 0:
+        raise FFmpegError(returncode, stderr)
+    return stderr
+
+
+def popen(*args, **kwargs):
+
+    call_args = [_ffmpeg] + list(args)
+
+    return processes.popen(call_args, **kwargs)
+
+
+def cancel():
+    processes.cancel()
+
+
+def reset():
+    processes.reset()
+
+
+def ffprobe_path():
+    dir_path, file_name = os.path.split(_ffmpeg)
+    return os.path.join(dir_path, file_name.replace('ffmpeg', 'ffprobe'))
+
@@ -1,22 +1,60 @@
 #!/usr/bin/env python
 
 import sys
-import os
-import re
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, QSettings, QThread, pyqtSignal
 
-import subtitles
-import converter
-import ffmpeg
+# The conversion modules are imported on first use (and preloaded in the
+# background once the window is up), so the window shows right away
 
 
-def natural_sort(l): 
-    convert = lambda text: int(text) if text.isdigit() else text.lower() 
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] 
-    return sorted(l, key = alphanum_key)
+def show_ffmpeg_error(path, e):
+    QMessageBox.information(None, '', path + '\n\n' + str(e))
+
+
+class FFmpegCheck_Thread(QThread):
+    # Validates ffmpeg off the GUI thread, ffmpeg.init remembers binaries that passed before
+
+    checked = pyqtSignal(bool, str)
+
+    def __init__(self, path, parent=None):
+        super(FFmpegCheck_Thread, self).__init__(parent)
+        self.path = path
+
+    def run(self):
+        import ffmpeg
+
+        errors = []
+        ok = ffmpeg.init(self.path, lambda path, e: errors.append(path + '\n\n' + str(e)))
+        self.checked.emit(ok, errors[-1] if errors else '')
+
+        # Preload what the first conversion needs while the user fills in the window
+        import pipeline
+        import converter
+
+
+def ask_ffmpeg_path():
+    import ffmpeg
+
+    settings = QSettings()
+
+    while True:
+        r = QMessageBox.information(None, '', 'ffmpeg was not found. Please select a path to ffmpeg.', QMessageBox.Ok | QMessageBox.Cancel)
+        if r != QMessageBox.Ok:
+            return False
+
+        path = QFileDialog.getOpenFileName(None, 'Select ffmpeg')[0]
+        if not path:
+            return False
+
+        if not ffmpeg.init(path, show_ffmpeg_error):
+            continue
+
+        settings.setValue('ffmpeg_path', path)
+
+        return True
 
 
 class ClickableLable_Widget(QLabel):
@@ -93,7 +131,7 @@ class ExportCheck_Dialog(QDialog):
         for (i, (media_file, subtitle_file, output_file)) in enumerate(zip(media_files, subtitle_files, output_files)):
             self.table.insertRow(self.table.rowCount())
             self.table.setItem(i, 0, QTableWidgetItem(media_file))
-            self.table.setItem(i, 1, QTableWidgetItem(subtitle_file))
+            self.table.setItem(i, 1, QTableWidgetItem(subtitle_file or '<Audio>'))
             self.table.setItem(i, 2, QTableWidgetItem(output_file))
 
         for i in range(self.table.columnCount()):
@@ -130,6 +168,16 @@ class MainWindow(QMainWindow):
         self.fs_subtitle = FileSelector_Widget('Subtitle File', filter='Subtitle Files (*.srt *.ass)')
         self.lyt.addWidget(self.fs_subtitle)
 
+        self.sub_lang_lyt = QHBoxLayout()
+        self.sub_lang_lyt.addWidget(QLabel('Preferred Subtitle Languages:'))
+        self.sub_langs = QLineEdit()
+        self.sub_langs.setPlaceholderText('e.g. ja, jpn for ep01.ja.srt')
+        self.sub_lang_lyt.addWidget(self.sub_langs)
+        self.lyt.addLayout(self.sub_lang_lyt)
+
+        self.audio_fallback = QCheckBox('Detect speech from the audio if there are no subtitles')
+        self.lyt.addWidget(self.audio_fallback)
+
         self.lyt.addWidget(HLine_Widget())
 
         self.condense_lyt = QGridLayout()
@@ -160,6 +208,69 @@ class MainWindow(QMainWindow):
         self.condense_lyt.addWidget(self.condense_post_pad, 2, 1)
         self.condense_lyt.addWidget(QLabel('seconds'), 2, 2)
 
+        self.condense_vad = QCheckBox('Trim to Speech:')
+        self.condense_lyt.addWidget(self.condense_vad, 3, 0)
+        self.condense_vad_threshold = QDoubleSpinBox()
+        self.condense_vad_threshold.setRange(-90.0, 0.0)
+        self.condense_vad_threshold.setValue(-30.0)
+        self.condense_vad_threshold.setEnabled(False)
+        self.condense_vad.toggled.connect(self.condense_vad_threshold.setEnabled)
+        self.condense_lyt.addWidget(self.condense_vad_threshold, 3, 1)
+        self.condense_lyt.addWidget(QLabel('dB'), 3, 2)
+
+        self.condense_filter = QCheckBox('Drop signs, songs and [sounds]')
+        self.condense_lyt.addWidget(self.condense_filter, 4, 0, 1, 3)
+
+        self.condense_lyt.addWidget(QLabel('Drop Lines Matching:'), 5, 0)
+        self.condense_drop_regex = QLineEdit()
+        self.condense_drop_regex.setPlaceholderText('Regular expression')
+        self.condense_lyt.addWidget(self.condense_drop_regex, 5, 1, 1, 2)
+
+        self.condense_lyt.addWidget(QLabel('Extraction:'), 6, 0)
+        self.condense_extract_mode = QComboBox()
+        self.condense_extract_mode.addItem('Per part', 'parts')
+        self.condense_extract_mode.addItem('Single pass', 'single_pass')
+        self.condense_extract_mode.addItem('Stream copy', 'copy')
+        self.condense_extract_mode.addItem('Cached PCM', 'pcm_cache')
+        self.condense_extract_mode.addItem('Streaming', 'stream')
+        self.condense_lyt.addWidget(self.condense_extract_mode, 6, 1, 1, 2)
+
+        self.condense_lyt.addWidget(QLabel('Bitrate:'), 7, 0)
+        self.condense_bitrate = QSpinBox()
+        self.condense_bitrate.setRange(0, 320)
+        self.condense_bitrate.setSpecialValueText('Auto')
+        self.condense_bitrate.setToolTip('Auto uses the highest VBR quality for mp3, 64 kbit/s for aac and 32 kbit/s for opus')
+        self.condense_lyt.addWidget(self.condense_bitrate, 7, 1)
+        self.condense_lyt.addWidget(QLabel('kbit/s'), 7, 2)
+
+        self.condense_lyt.addWidget(QLabel('Parallel Jobs:'), 8, 0)
+        self.condense_num_workers = QSpinBox()
+        self.condense_num_workers.setRange(0, 256)
+        self.condense_num_workers.setSpecialValueText('Auto')
+        self.condense_lyt.addWidget(self.condense_num_workers, 8, 1)
+
+        self.condense_lyt.addWidget(QLabel('Parallel Parts:'), 9, 0)
+        self.condense_part_workers = QSpinBox()
+        self.condense_part_workers.setRange(0, 256)
+        self.condense_part_workers.setSpecialValueText('Auto')
+        self.condense_lyt.addWidget(self.condense_part_workers, 9, 1)
+
+        self.condense_incremental = QCheckBox('Skip up-to-date outputs')
+        self.condense_lyt.addWidget(self.condense_incremental, 10, 0, 1, 3)
+
+        self.condense_combine = QCheckBox('Combine into one file with a chapter per media file')
+        self.condense_lyt.addWidget(self.condense_combine, 11, 0, 1, 3)
+
+        self.condense_normalize = QCheckBox('Normalize Loudness:')
+        self.condense_lyt.addWidget(self.condense_normalize, 12, 0)
+        self.condense_normalize_lufs = QDoubleSpinBox()
+        self.condense_normalize_lufs.setRange(-40.0, -5.0)
+        self.condense_normalize_lufs.setValue(-16.0)
+        self.condense_normalize_lufs.setSuffix(' LUFS')
+        self.condense_normalize_lufs.setEnabled(False)
+        self.condense_normalize.toggled.connect(self.condense_normalize_lufs.setEnabled)
+        self.condense_lyt.addWidget(self.condense_normalize_lufs, 12, 1)
+
         self.lyt.addWidget(HLine_Widget())
 
         self.metadata_lyt = QGridLayout()
@@ -181,79 +292,80 @@ class MainWindow(QMainWindow):
 
         self.lyt.addWidget(HLine_Widget())
 
-        self.fs_output = FileSelector_Widget('Output File', is_save=True, filter='MP3 (*.mp3)')
+        self.fs_output = FileSelector_Widget('Output File', is_save=True, filter='MP3 (*.mp3);;AAC (*.m4a *.aac);;Opus (*.opus *.ogg)')
         self.lyt.addWidget(self.fs_output)
 
         self.lyt.addWidget(HLine_Widget())
 
-        self.convert_btn = QPushButton('Convert')
+        self.convert_btn = QPushButton('Checking ffmpeg...')
+        self.convert_btn.setEnabled(False)
         self.convert_btn.clicked.connect(self.on_convert)
         self.lyt.addWidget(self.convert_btn)
 
         self.lyt.addStretch()
 
 
-    def on_convert(self):
-        media_path = self.fs_media.path()
-        subtitle_path = self.fs_subtitle.path()
-        output_path = self.fs_output.path()
-
-        media_files = natural_sort(self.files_from_path(media_path))
-
-        if len(media_files) < 1:
-            QMessageBox.warning(self, self.windowTitle(), 'No media input files found')
-            return
+    def on_ffmpeg_checked(self, ok, error):
+        if not ok:
+            if error:
+                QMessageBox.information(self, '', error)
+            if not ask_ffmpeg_path():
+                self.close()
+                return
 
+        self.convert_btn.setText('Convert')
+        self.convert_btn.setEnabled(True)
 
-        subtitle_files = []
-        if subtitle_path.strip() == '':
-            for media_file in media_files:
-                subtitle_file = subtitles.find_sub_for_path(media_file)
-                if subtitle_file is None:
-                    QMessageBox.warning(self, self.windowTitle(), 'No subtitle file was found for\n\n' + media_file)
-                    return
-                subtitle_files.append(subtitle_file)
-        else:
-            subtitle_files = natural_sort(self.files_from_path(subtitle_path))
-
-        output_files = []
-        output_num_asterisk = output_path.count('*')
-        if output_num_asterisk > 1:
-            QMessageBox.warning(self, self.windowTitle(), 'The output path is invalid')
+    def on_convert(self):
+        import pipeline
+        import cuefilter
+        import converter
+
+        cue_filters = ('nonspeech',) if self.condense_filter.isChecked() else ()
+        if self.condense_drop_regex.text():
+            cue_filters += ('regex:' + self.condense_drop_regex.text(),)
+
+        try:
+            cuefilter.compile(cue_filters)
+            pipeline.check_album_art(self.album_art_path)
+        except ValueError as e:
+            QMessageBox.warning(self, self.windowTitle(), str(e))
             return
-        elif output_num_asterisk == 1:
-            if len(media_files) > 1:
-                start_cut = media_path.index('*')
-                end_cut = len(media_path) - 1 - start_cut
-                for media_file in media_files:
-                    filter_fill = media_file[start_cut:-end_cut]
-                    output_file = output_path.replace('*', filter_fill)
-                    output_files.append(output_file)
-        else:
-            output_files = [output_path]
 
-        if len(media_files) != len(subtitle_files):
-            QMessageBox.warning(self, self.windowTitle(), 'Matching media files with subtitle files failed.')
+        try:
+            sub_langs = [l.strip() for l in self.sub_langs.text().split(',') if l.strip()]
+            jobs = pipeline.plan_jobs(self.fs_media.path(), self.fs_subtitle.path(), self.fs_output.path(), self.audio_fallback.isChecked(), sub_langs,
+                                      self.condense_combine.isChecked())
+        except pipeline.PlanError as e:
+            QMessageBox.warning(self, self.windowTitle(), str(e))
             return
 
-        if len(media_files) != len(output_files):
-            QMessageBox.warning(self, self.windowTitle(), 'Matching media files with output files failed.')
-            return
+        media_files = [job.media_file for job in jobs]
+        subtitle_files = [job.subtitle_file for job in jobs]
+        output_files = [job.output_file for job in jobs]
 
         r = ExportCheck_Dialog(media_files, subtitle_files, output_files, self).exec_()
 
         if r != ExportCheck_Dialog.Accepted:
             return
 
-        jobs = [converter.Job(*t) for t in zip(media_files, subtitle_files, output_files)]
-
-        options = converter.Options(
+        options = pipeline.Options(
             self.condense_join_max.value(),
             self.condense_pre_pad.value(),
-            self.condense_post_pad.value()
+            self.condense_post_pad.value(),
+            self.condense_extract_mode.currentData(),
+            self.condense_num_workers.value(),
+            self.condense_part_workers.value(),
+            self.condense_incremental.isChecked(),
+            None,
+            self.condense_vad_threshold.value() if self.condense_vad.isChecked() else None,
+            cue_filters,
+            self.condense_bitrate.value() or None,
+            self.condense_combine.isChecked(),
+            self.condense_normalize_lufs.value() if self.condense_normalize.isChecked() else None
         )
 
-        metadata = converter.Metadata(
+        metadata = pipeline.Metadata(
             self.metadata_album.text().rstrip(),
             self.album_art_path
         )
@@ -277,39 +389,6 @@ class MainWindow(QMainWindow):
         QMessageBox.warning(self, self.windowTitle(), 'Finished!')
 
 
-    @staticmethod
-    def files_from_path(path):
-        
-        num_asterisk = path.count('*')
-
-        if num_asterisk >= 2:
-            return []
-        if num_asterisk == 0:
-            if os.path.isfile(path):
-                return [path]
-            else:
-                return []
-
-        dir_path = os.path.dirname(path)
-        file_filter = os.path.basename(path)
-
-        # Filter must be inside target dir
-        if dir_path.find('*') >= 0:
-            return []
-
-        parts = file_filter.split('*')
-
-        files = []
-
-        for file_name in os.listdir(dir_path):
-            file_path = os.path.join(dir_path, file_name)
-            if os.path.isfile(file_path):
-                if file_name.startswith(parts[0]) and file_name.endswith(parts[1]):
-                    files.append(file_path)
-
-        return files
-
-
 
 def main(argv):
     app = QApplication(argv)
@@ -317,12 +396,13 @@ def main(argv):
     app.setOrganizationDomain("http://bent.smbnext.net/")
     app.setApplicationName('ImmersionAudioTool')
 
-    if not ffmpeg.init():
-        return 0
-
     window = MainWindow()
     window.show()
 
+    ffmpeg_check = FFmpegCheck_Thread(QSettings().value('ffmpeg_path', 'ffmpeg'), window)
+    ffmpeg_check.checked.connect(window.on_ffmpeg_checked)
+    ffmpeg_check.start()
+
     return app.exec_()
 
 
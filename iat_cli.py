@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import signal
+import argparse
+import threading
+
+import pipeline
+import cuefilter
+import loudness
+import ffmpeg
+
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_FFMPEG = 3
+EXIT_CANCELLED = 130
+
+
+class EventPrinter:
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        self.emit_event({'event': event, **fields})
+
+    def emit_event(self, fields):
+        line = json.dumps(fields)
+        with self.lock:
+            self.out.write(line + '\n')
+            self.out.flush()
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Creates condensed audio from media files for language immersion')
+
+    parser.add_argument('media', help='media file, may contain * and ? wildcards and ** for any number of folders')
+    parser.add_argument('-s', '--subtitle', default='',
+                        help='subtitle file, may contain wildcards like the media file. Defaults to the subtitle next to each media file')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output file (' + ', '.join(pipeline.output_profiles.keys()) + '), needs one * for multiple media files, '
+                             'which is replaced by the part of the media path matched by the wildcards')
+    parser.add_argument('--combine', action='store_true',
+                        help='write all media files into the one output file, with a chapter per media file (mp3, m4a, opus, ogg)')
+    parser.add_argument('--incremental', action='store_true', help='skip media files whose output is up to date')
+
+    add_conversion_args(parser)
+
+    return parser
+
+
+def add_conversion_args(parser):
+    # Everything options_from_args and metadata_from_args read, except the
+    # batch settings combine and incremental. Shared with iat_daemon.
+    parser.add_argument('--sub-lang', action='append', default=[], metavar='LANG',
+                        help='preferred language suffix of the subtitles next to the media files, e.g. ja for ep01.ja.srt (repeatable)')
+    parser.add_argument('--audio-fallback', action='store_true',
+                        help='detect speech from the audio for media files without a subtitle file (needs numpy)')
+    parser.add_argument('-b', '--bitrate', type=int, default=None, metavar='KBPS',
+                        help='output bitrate in kbit/s (default: VBR -q:a 0 for mp3, 64 for aac, 32 for opus)')
+
+    parser.add_argument('--join', type=float, default=2.0, help='join subtitles at most this many seconds apart (default: 2.0)')
+    parser.add_argument('--pre-pad', type=float, default=0.0, help='seconds added before each subtitle')
+    parser.add_argument('--post-pad', type=float, default=0.0, help='seconds added after each subtitle')
+    parser.add_argument('--trim-speech', type=float, default=None, metavar='DB',
+                        help='trim subtitle lines to where the audio is at most DB below its loud parts, e.g. -30 (needs numpy)')
+    parser.add_argument('--filter-nonspeech', action='store_true',
+                        help='drop signs, songs, karaoke, typesetting and lines like [music] before merging')
+    parser.add_argument('--drop-style', action='append', default=[], metavar='REGEX', help='drop ass lines whose style matches REGEX (repeatable)')
+    parser.add_argument('--drop-layer', type=int, default=None, metavar='N', help='drop ass lines on layer N or above')
+    parser.add_argument('--drop-regex', action='append', default=[], metavar='REGEX', help='drop lines whose text matches REGEX (repeatable)')
+    parser.add_argument('--normalize', type=float, nargs='?', const=loudness.DEFAULT_TARGET_LUFS, default=None, metavar='LUFS',
+                        help='normalize the loudness of each media file to LUFS (default: %(const)s), measured over the extracted parts only')
+    parser.add_argument('--extract-mode', choices=list(pipeline.extractors.keys()), default='parts')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='media files converted in parallel (default: CPU count)')
+    parser.add_argument('--part-jobs', type=int, default=0, help='parts encoded in parallel per media file (default: shared CPU count)')
+    parser.add_argument('--trace', default=None, help='append all events to this JSONL file')
+
+    parser.add_argument('--album', default='', help='album name')
+    parser.add_argument('--album-art', default=None, help='album art image (png/jpg)')
+
+    parser.add_argument('--ffmpeg', default=os.environ.get('IAT_FFMPEG', 'ffmpeg'), help='path to ffmpeg (default: $IAT_FFMPEG or ffmpeg)')
+
+
+def options_from_args(args):
+    return pipeline.Options(
+        args.join,
+        args.pre_pad,
+        args.post_pad,
+        args.extract_mode,
+        args.jobs,
+        args.part_jobs,
+        args.incremental,
+        args.trace,
+        args.trim_speech,
+        cue_filters_from_args(args),
+        args.bitrate,
+        args.combine,
+        args.normalize
+    )
+
+
+def cue_filters_from_args(args):
+    specs = ['nonspeech'] if args.filter_nonspeech else []
+    specs += [F'style:{r}' for r in args.drop_style]
+    if args.drop_layer is not None:
+        specs.append(F'layer:{args.drop_layer}')
+    specs += [F'regex:{r}' for r in args.drop_regex]
+    return tuple(specs)
+
+
+def metadata_from_args(args):
+    return pipeline.Metadata(
+        args.album.rstrip(),
+        args.album_art
+    )
+
+
+def main(argv):
+    args = build_arg_parser().parse_args(argv)
+    events = EventPrinter()
+
+    def on_ffmpeg_error(path, e):
+        events.emit('error', message=F'{path}: {e}')
+
+    if not ffmpeg.init(args.ffmpeg, on_ffmpeg_error):
+        events.emit('error', message='ffmpeg was not found')
+        return EXIT_NO_FFMPEG
+
+    try:
+        cuefilter.compile(cue_filters_from_args(args))
+        pipeline.check_album_art(args.album_art)
+    except ValueError as e:
+        events.emit('error', message=str(e))
+        return EXIT_USAGE
+
+    try:
+        jobs = pipeline.plan_jobs(args.media, args.subtitle, args.output, args.audio_fallback, args.sub_lang, args.combine)
+    except pipeline.PlanError as e:
+        events.emit('error', message=str(e).replace('\n\n', ' '))
+        return EXIT_USAGE
+
+    def on_progress(progress):
+        events.emit('progress', progress=round(progress, 4))
+
+    converter = pipeline.Converter(jobs, options_from_args(args), metadata_from_args(args), on_progress, events.emit_event)
+
+    # Stop ffmpeg and let the jobs clean up instead of dying mid-write
+    def on_signal(signum, frame):
+        converter.cancel()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    converter.run()
+
+    if converter.cancelled:
+        return EXIT_CANCELLED
+    return EXIT_FAILED if converter.errors else EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
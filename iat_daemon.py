@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import struct
+import sqlite3
+import argparse
+import threading
+import ctypes
+import ctypes.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pipeline
+import discovery
+import subtitles
+import cuefilter
+import cache
+import ffmpeg
+import iat_cli
+
+
+# Watches folders and condenses media files as they appear. New and changed
+# files go into a SQLite queue next to the outputs, so a restart picks up
+# where the last run stopped. A file is converted once it has not changed for
+# a few seconds, media files without subtitles wait until one shows up.
+
+MEDIA_EXTENSIONS = {
+    '.mkv', '.mp4', '.m4v', '.avi', '.webm', '.mov', '.ts', '.flv', '.wmv',
+    '.mp3', '.m4a', '.aac', '.flac', '.ogg', '.opus', '.wav', '.wma',
+}
+
+# Browsers and download clients write to these before renaming the finished file
+PARTIAL_EXTENSIONS = {'.part', '.partial', '.tmp', '.crdownload', '.download', '.!qb'}
+
+QUEUE_NAME = '.iat_queue.sqlite3'
+QUEUE_VERSION = 1
+
+DEFAULT_SETTLE_SECS = 5.0
+DEFAULT_POLL_SECS = 10.0
+DEFAULT_STATS_PORT = 8765
+
+# A failed file is tried again after RETRY_SECS times the number of attempts
+RETRY_SECS = 60.0
+
+IDLE_SECS = 1.0
+
+
+class JobQueue:
+    # States: queued (ready_at says when), running, waiting (for a subtitle),
+    # done and failed. Safe to use from any thread.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != QUEUE_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS jobs')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                               id INTEGER PRIMARY KEY,
+                               media_file TEXT NOT NULL UNIQUE,
+                               dir TEXT NOT NULL,
+                               output_file TEXT NOT NULL,
+                               file_key TEXT NOT NULL,
+                               state TEXT NOT NULL,
+                               attempts INTEGER NOT NULL DEFAULT 0,
+                               ready_at REAL NOT NULL,
+                               added_at REAL NOT NULL,
+                               started_at REAL,
+                               finished_at REAL,
+                               audio_secs REAL,
+                               secs REAL,
+                               error TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, ready_at)')
+        self.db.execute(F'PRAGMA user_version = {QUEUE_VERSION}')
+
+        # Conversions of the last run that never finished
+        self.db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+        self.db.commit()
+
+    def add(self, media_file, output_file, file_key, ready_at):
+        # Returns True if media_file is new or changed since it was queued
+        with self.lock:
+            row = self.db.execute('SELECT file_key FROM jobs WHERE media_file = ?', (media_file,)).fetchone()
+            if row is not None and row[0] == file_key:
+                return False
+
+            if row is None:
+                self.db.execute("INSERT INTO jobs (media_file, dir, output_file, file_key, state, ready_at, added_at) "
+                                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                                (media_file, os.path.dirname(media_file), output_file, file_key, ready_at, time.time()))
+            else:
+                # A running conversion finds out in finish() that its file changed,
+                # its attempt is still counted until then
+                self.db.execute("UPDATE jobs SET file_key = ?, ready_at = ?, error = NULL, "
+                                "attempts = CASE state WHEN 'running' THEN attempts ELSE 0 END, "
+                                "state = CASE state WHEN 'running' THEN 'running' ELSE 'queued' END WHERE media_file = ?",
+                                (file_key, ready_at, media_file))
+            self.db.commit()
+            return True
+
+    def claim(self, now):
+        # Returns (id, media_file, output_file, file_key, attempt) of the next
+        # job that is due, None if there is none
+        with self.lock:
+            row = self.db.execute("SELECT id, media_file, output_file, file_key, attempts + 1 FROM jobs "
+                                  "WHERE state = 'queued' AND ready_at <= ? ORDER BY ready_at, id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE jobs SET state = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?", (now, row[0]))
+            self.db.commit()
+            return row
+
+    def finish(self, job_id, claimed_key, state, ready_at=None, audio_secs=None, secs=None, error=None):
+        # Returns the state the job ended up in
+        with self.lock:
+            row = self.db.execute('SELECT file_key, attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+
+            if row[0] != claimed_key:
+                # The file changed while it was converted, the new version is queued
+                # with all of its attempts
+                self.db.execute("UPDATE jobs SET state = 'queued', ready_at = ?, attempts = 0 WHERE id = ?", (time.time(), job_id))
+                self.db.commit()
+                return 'queued'
+
+            if state == 'retry':
+                state = 'queued'
+                ready_at = time.time() + RETRY_SECS * row[1]
+            elif state == 'skipped':
+                # Nothing was converted, the numbers of the last conversion stay
+                self.db.execute("UPDATE jobs SET state = 'done' WHERE id = ?", (job_id,))
+                self.db.commit()
+                return state
+
+            self.db.execute('UPDATE jobs SET state = ?, ready_at = COALESCE(?, ready_at), finished_at = ?, '
+                            'audio_secs = ?, secs = ?, error = ? WHERE id = ?',
+                            (state, ready_at, time.time(), audio_secs, secs, error, job_id))
+            self.db.commit()
+            return state
+
+    def release(self, job_id, ready_at, state='queued'):
+        # Puts a claimed job back without counting the attempt
+        with self.lock:
+            self.db.execute('UPDATE jobs SET state = ?, ready_at = ?, attempts = attempts - 1 WHERE id = ?', (state, ready_at, job_id))
+            self.db.commit()
+
+    def remove(self, job_id):
+        with self.lock:
+            self.db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            self.db.commit()
+
+    def wake(self, dir_path, now):
+        # Media files of dir_path that wait for a subtitle are tried again, converted
+        # ones too as the subtitle may be theirs. The manifest skips those it is not for.
+        with self.lock:
+            n = self.db.execute("UPDATE jobs SET state = 'queued', ready_at = ?, attempts = 0, error = NULL "
+                                "WHERE state IN ('waiting', 'done') AND dir = ?",
+                                (now, dir_path)).rowcount
+            self.db.commit()
+            return n
+
+    def stats(self, since):
+        # Returns ({state: count}, (jobs, audio secs, conversion secs) done since since)
+        with self.lock:
+            counts = dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            recent = self.db.execute("SELECT COUNT(*), COALESCE(SUM(audio_secs), 0), COALESCE(SUM(secs), 0) FROM jobs "
+                                     "WHERE state = 'done' AND finished_at >= ?", (since,)).fetchone()
+            return counts, recent
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Watchers call on_file(path) for every file that was written or moved into
+# a watched folder, scan() reports all files that are there already.
+
+def walk_files(dir_path):
+    try:
+        with os.scandir(dir_path) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path)
+            elif entry.is_file():
+                yield entry
+        except OSError:
+            continue
+
+
+class PollingWatcher:
+    name = 'polling'
+
+    def __init__(self, dirs, on_file, interval=DEFAULT_POLL_SECS):
+        self.dirs = dirs
+        self.on_file = on_file
+        self.interval = interval
+        self.seen = {}
+
+    def poll(self):
+        seen = {}
+        for dir_path in self.dirs:
+            for entry in walk_files(dir_path):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                seen[entry.path] = (st.st_size, st.st_mtime_ns)
+                if self.seen.get(entry.path) != seen[entry.path]:
+                    self.on_file(entry.path)
+        self.seen = seen
+
+    def scan(self):
+        self.poll()
+
+    def run(self, stop_event):
+        while not stop_event.wait(self.interval):
+            self.poll()
+
+    def close(self):
+        pass
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_inotify_event = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    name = 'inotify'
+
+    def __init__(self, dirs, on_file):
+        libc_path = ctypes.util.find_library('c')
+        if libc_path is None:
+            raise OSError(errno.ENOSYS, 'libc was not found')
+
+        self.libc = ctypes.CDLL(libc_path, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'libc has no inotify')
+
+        self.dirs = dirs
+        self.on_file = on_file
+        self.watches = {}
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        try:
+            for dir_path in dirs:
+                self.add_tree(dir_path, False)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), INOTIFY_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            # Out of watches, polling is the only way to see everything
+            if e == errno.ENOSPC:
+                raise OSError(e, 'inotify watch limit reached (fs.inotify.max_user_watches)')
+            return
+        self.watches[wd] = dir_path
+
+    def add_tree(self, dir_path, report):
+        # Files may land in a new folder before it is watched, report lists them
+        self.add_watch(dir_path)
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    self.add_tree(entry.path, report)
+                elif report and entry.is_file():
+                    self.on_file(entry.path)
+            except OSError:
+                continue
+
+    def scan(self):
+        for dir_path in self.dirs:
+            for entry in walk_files(dir_path):
+                self.on_file(entry.path)
+
+    def run(self, stop_event):
+        while not stop_event.is_set():
+            readable, _, _ = select.select([self.fd], [], [], IDLE_SECS)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_len = _inotify_event.unpack_from(data, offset)
+                offset += _inotify_event.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                self.handle(wd, mask, name)
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, look at everything again
+            for dir_path in self.dirs:
+                self.add_tree(dir_path, True)
+            return
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        dir_path = self.watches.get(wd)
+        if dir_path is None:
+            return
+        path = os.path.join(dir_path, name)
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path, True)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.on_file(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(dirs, on_file, poll_secs, events):
+    if poll_secs is None and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(dirs, on_file)
+        except OSError as e:
+            events.emit('warning', message=F'inotify is not available ({e.strerror}), polling instead')
+    return PollingWatcher(dirs, on_file, poll_secs or DEFAULT_POLL_SECS)
+
+
+class Service:
+
+    def __init__(self, watch_dirs, output_dir, extension, queue, options, metadata, events,
+                 num_workers, settle_secs=DEFAULT_SETTLE_SECS, max_attempts=3, audio_fallback=False, subtitle_languages=()):
+        self.watch_dirs = watch_dirs
+        self.output_dir = output_dir
+        self.extension = extension
+        self.queue = queue
+        self.options = options
+        self.metadata = metadata
+        self.events = events
+        self.num_workers = num_workers
+        self.settle_secs = settle_secs
+        self.max_attempts = max_attempts
+        self.audio_fallback = audio_fallback
+        self.subtitle_languages = subtitle_languages
+        self.subtitle_extensions = {'.' + e for e in subtitles.parsers.keys()}
+
+        self.watcher = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.converters = set()
+        self.start_time = time.time()
+        self.totals = {'done': 0, 'failed': 0, 'audio_secs': 0.0}
+
+    def output_path(self, media_file):
+        # Mirrors the watched folders, each under its own name if there are several
+        root = max((d for d in self.watch_dirs if media_file.startswith(d + os.sep)), key=len)
+        rel_path = os.path.relpath(media_file, root)
+        if len(self.watch_dirs) > 1:
+            rel_path = os.path.join(os.path.basename(root), rel_path)
+        return os.path.join(self.output_dir, os.path.splitext(rel_path)[0] + self.extension)
+
+    def on_file(self, path):
+        name = os.path.basename(path)
+        extension = os.path.splitext(name)[1].lower()
+
+        if name.startswith('.') or extension in PARTIAL_EXTENSIONS or path.startswith(self.output_dir + os.sep):
+            return
+
+        if extension in self.subtitle_extensions:
+            if self.queue.wake(os.path.dirname(path), time.time()):
+                self.events.emit('subtitle_found', subtitle_file=path)
+            return
+
+        if extension not in MEDIA_EXTENSIONS:
+            return
+
+        try:
+            file_key = cache.file_key(path)
+        except OSError:
+            return
+
+        if self.queue.add(path, self.output_path(path), file_key, time.time() + self.settle_secs):
+            self.events.emit('queued', media_file=path)
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            row = self.queue.claim(time.time())
+            if row is None:
+                self.stop_event.wait(IDLE_SECS)
+                continue
+            self.run_job(*row)
+
+    def run_job(self, job_id, media_file, output_file, claimed_key, attempt):
+        now = time.time()
+        try:
+            file_key = cache.file_key(media_file)
+            mtime = os.path.getmtime(media_file)
+        except OSError:
+            self.queue.remove(job_id)
+            self.events.emit('removed', media_file=media_file)
+            return
+
+        # Still being written
+        if file_key != claimed_key or now - mtime < self.settle_secs:
+            self.queue.add(media_file, output_file, file_key, now + self.settle_secs)
+            self.queue.release(job_id, now + self.settle_secs)
+            return
+
+        subtitle_file = discovery.SubtitleIndex(discovery.DirCache(), self.subtitle_languages).find(media_file)
+        if subtitle_file is None and not self.audio_fallback:
+            self.queue.release(job_id, now, 'waiting')
+            self.events.emit('waiting', media_file=media_file, reason='no subtitle file')
+            return
+
+        job = pipeline.Job(media_file, subtitle_file, output_file)
+        job_end = {}
+
+        def on_event(e):
+            if e['event'] == 'job_end':
+                job_end.update(e)
+            self.events.emit_event({**e, 'queue_id': job_id})
+
+        converter = pipeline.Converter([job], self.options, self.metadata, None, on_event)
+
+        with self.lock:
+            if self.stop_event.is_set():
+                self.queue.release(job_id, now)
+                return
+            self.converters.add(converter)
+
+        t = time.perf_counter()
+        try:
+            converter.run()
+        finally:
+            with self.lock:
+                self.converters.discard(converter)
+        secs = time.perf_counter() - t
+
+        if converter.cancelled:
+            self.queue.release(job_id, time.time())
+            return
+
+        if converter.skipped:
+            self.queue.finish(job_id, claimed_key, 'skipped')
+            return
+
+        if converter.errors:
+            error = str(converter.errors[0][1])
+            state = self.queue.finish(job_id, claimed_key, 'retry' if attempt < self.max_attempts else 'failed', secs=secs, error=error)
+            if state == 'failed':
+                with self.lock:
+                    self.totals['failed'] += 1
+                self.events.emit('given_up', media_file=media_file, attempts=attempt, error=error)
+            return
+
+        audio_secs = job_end.get('audio_secs', 0)
+        state = self.queue.finish(job_id, claimed_key, 'done', audio_secs=audio_secs, secs=secs)
+        if state == 'done':
+            with self.lock:
+                self.totals['done'] += 1
+                self.totals['audio_secs'] += audio_secs
+
+    def stats(self):
+        now = time.time()
+        counts, (recent_jobs, recent_audio_secs, recent_secs) = self.queue.stats(now - 3600)
+        with self.lock:
+            totals = dict(self.totals)
+
+        uptime = now - self.start_time
+        return {
+            'watcher': self.watcher.name if self.watcher else None,
+            'uptime_secs': round(uptime, 1),
+            'workers': self.num_workers,
+            'queue_depth': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'waiting_for_subtitles': counts.get('waiting', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'last_hour': {
+                'jobs': recent_jobs,
+                'audio_secs': round(recent_audio_secs, 1),
+                'conversion_secs': round(recent_secs, 1),
+                # Seconds of condensed audio per second a worker was busy
+                'speed': round(recent_audio_secs / recent_secs, 2) if recent_secs > 0 else None,
+            },
+            'since_start': {
+                'jobs': totals['done'],
+                'failed': totals['failed'],
+                'audio_secs': round(totals['audio_secs'], 1),
+                'jobs_per_hour': round(totals['done'] * 3600 / uptime, 2) if uptime > 0 else None,
+            },
+        }
+
+    def run(self, poll_secs=None, stats_port=DEFAULT_STATS_PORT):
+        # Watch first, so nothing that lands during the first scan is missed
+        self.watcher = make_watcher(self.watch_dirs, self.on_file, poll_secs, self.events)
+        self.events.emit('service_start', watch_dirs=self.watch_dirs, output_dir=self.output_dir,
+                         watcher=self.watcher.name, workers=self.num_workers)
+        self.watcher.scan()
+
+        threads = [threading.Thread(target=self.worker, name=F'worker-{i}') for i in range(self.num_workers)]
+        threads.append(threading.Thread(target=self.watcher.run, args=(self.stop_event,), name='watcher'))
+
+        server = None
+        if stats_port:
+            server = ThreadingHTTPServer(('127.0.0.1', stats_port), StatsHandler)
+            server.daemon_threads = True
+            server.service = self
+            threads.append(threading.Thread(target=server.serve_forever, name='stats', daemon=True))
+            self.events.emit('stats_server', url=F'http://127.0.0.1:{server.server_address[1]}/stats')
+
+        for thread in threads:
+            thread.start()
+
+        # The main thread has to stay free for the signal handlers
+        while not self.stop_event.wait(IDLE_SECS):
+            pass
+
+        for thread in threads:
+            if not thread.daemon:
+                thread.join()
+
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        self.watcher.close()
+
+        self.events.emit('service_stop', stats=self.stats())
+
+    def stop(self):
+        # Safe to call from a signal handler, running conversions are cancelled and queued again
+        with self.lock:
+            self.stop_event.set()
+            converters = list(self.converters)
+        for converter in converters:
+            converter.cancel()
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') != '/stats':
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.server.service.stats(), indent=1).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Watches folders and condenses new media files as they appear')
+
+    parser.add_argument('watch', nargs='+', help='folders to watch, including their sub folders')
+    parser.add_argument('-o', '--output-dir', required=True, help='folder for the outputs, mirrors the watched folders')
+    parser.add_argument('-f', '--format', default='mp3', choices=[e[1:] for e in pipeline.output_profiles.keys()],
+                        help='output format (default: mp3)')
+    parser.add_argument('--queue', default=None, help=F'queue database (default: {QUEUE_NAME} in the output folder)')
+    parser.add_argument('--poll', type=float, default=None, metavar='SECS', help='poll the folders every SECS instead of using inotify')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_SECS, metavar='SECS',
+                        help='seconds a file has to stay unchanged before it is converted (default: %(default)s)')
+    parser.add_argument('--attempts', type=int, default=3, help='conversions of a file before it is given up on (default: %(default)s)')
+    parser.add_argument('--stats-port', type=int, default=DEFAULT_STATS_PORT, metavar='PORT',
+                        help='serve queue and throughput stats on http://127.0.0.1:PORT/stats, 0 turns it off (default: %(default)s)')
+
+    iat_cli.add_conversion_args(parser)
+
+    # Outputs are only rewritten when their inputs or the settings change
+    parser.set_defaults(incremental=True, combine=False)
+
+    return parser
+
+
+def main(argv):
+    args = build_arg_parser().parse_args(argv)
+    events = iat_cli.EventPrinter()
+
+    watch_dirs = [os.path.abspath(d) for d in args.watch]
+    for dir_path in watch_dirs:
+        if not os.path.isdir(dir_path):
+            events.emit('error', message=F'{dir_path} is not a folder')
+            return iat_cli.EXIT_USAGE
+
+    output_dir = os.path.abspath(args.output_dir)
+    for dir_path in watch_dirs:
+        # Files in the output folder are never converted, so it would watch nothing
+        if dir_path == output_dir or dir_path.startswith(output_dir + os.sep):
+            events.emit('error', message=F'{dir_path} is inside the output folder {output_dir}')
+            return iat_cli.EXIT_USAGE
+    os.makedirs(output_dir, exist_ok=True)
+
+    def on_ffmpeg_error(path, e):
+        events.emit('error', message=F'{path}: {e}')
+
+    if not ffmpeg.init(args.ffmpeg, on_ffmpeg_error):
+        events.emit('error', message='ffmpeg was not found')
+        return iat_cli.EXIT_NO_FFMPEG
+
+    try:
+        cuefilter.compile(iat_cli.cue_filters_from_args(args))
+        pipeline.check_album_art(args.album_art)
+    except ValueError as e:
+        events.emit('error', message=str(e))
+        return iat_cli.EXIT_USAGE
+
+    num_workers = args.jobs or os.cpu_count() or 1
+
+    # Every conversion is its own batch, so share the cores here
+    options = iat_cli.options_from_args(args)
+    options = options._replace(num_workers=1, part_workers=args.part_jobs or max((os.cpu_count() or 1) // num_workers, 1))
+
+    queue = JobQueue(args.queue or os.path.join(output_dir, QUEUE_NAME))
+
+    # Every conversion is a batch of one, a track number would always be 1
+    metadata = iat_cli.metadata_from_args(args)._replace(track_numbers=False)
+
+    service = Service(watch_dirs, output_dir, '.' + args.format, queue, options, metadata, events,
+                      num_workers, args.settle, args.attempts, args.audio_fallback, args.sub_lang)
+
+    def on_signal(signum, frame):
+        service.stop()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    try:
+        service.run(args.poll, args.stats_port)
+    finally:
+        queue.close()
+
+    return iat_cli.EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+# numpy is imported on the first merge large enough to use it, importing it
+# takes longer than most merges
+numpy = None
+_numpy_loaded = False
+
+
+def load_numpy():
+    global numpy, _numpy_loaded
+
+    if not _numpy_loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_loaded = True
+
+    return numpy
+
+
+# Below this many intervals the plain python merge is just as fast
+numpy_min_size = 100
+
+
+def merge(starts, ends, join_secs=0, pre_pad=0, post_pad=0):
+    # Padding is applied before merging so padded intervals never overlap.
+    # Gaps of up to join_secs between the unpadded intervals are joined, the
+    # same as before padding, but overlapping padding always joins.
+    threshold = max(join_secs - pre_pad - post_pad, 0)
+
+    if len(starts) >= numpy_min_size and load_numpy() is not None:
+        return merge_numpy(starts, ends, threshold, pre_pad, post_pad)
+
+    return merge_python(starts, ends, threshold, pre_pad, post_pad)
+
+
+def merge_python(starts, ends, threshold, pre_pad, post_pad):
+    merged = []
+
+    for (start, end) in sorted(zip(starts, ends)):
+        start = max(start - pre_pad, 0)
+        end = end + post_pad
+
+        if end <= start:
+            continue
+
+        if merged and start - merged[-1][1] <= threshold:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def merge_numpy(starts, ends, threshold, pre_pad, post_pad):
+    starts = numpy.maximum(numpy.asarray(starts, numpy.float64) - pre_pad, 0)
+    ends = numpy.asarray(ends, numpy.float64) + post_pad
+
+    valid = ends > starts
+    starts = starts[valid]
+    ends = ends[valid]
+
+    if len(starts) == 0:
+        return []
+
+    order = numpy.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+
+    # An interval opens a new group if it starts after everything before it ended
+    run_ends = numpy.maximum.accumulate(ends)
+    new_group = numpy.empty(len(starts), bool)
+    new_group[0] = True
+    new_group[1:] = starts[1:] - run_ends[:-1] > threshold
+
+    group_idxs = numpy.flatnonzero(new_group)
+    group_starts = starts[group_idxs]
+    group_ends = numpy.maximum.reduceat(ends, group_idxs)
+
+    return list(zip(group_starts.tolist(), group_ends.tolist()))
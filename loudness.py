@@ -0,0 +1,105 @@
+import os
+import re
+import json
+import hashlib
+import tempfile
+
+import cache
+import ffmpeg
+
+
+# EBU R128 loudness of the parts of a media file that end up in the output,
+# measured with ffmpeg's ebur128 filter. The gain is applied by the encode
+# that writes the output, so normalizing never costs an extra encode.
+
+DEFAULT_TARGET_LUFS = -16.0
+
+# Keeps the gain from pushing the loudest peak into clipping
+MAX_TRUE_PEAK_DB = -1.0
+
+# Nearly silent sources are not amplified beyond this
+MAX_GAIN_DB = 30.0
+
+LOUDNESS_VERSION = 1
+loudness_max_bytes = 4 * 1024 * 1024
+
+_summary_re = re.compile(r'Integrated loudness:\s*I:\s*(-?[0-9.]+|-inf) LUFS.*?True peak:\s*Peak:\s*(-?[0-9.]+|-inf) dBFS', re.S)
+
+
+def parts_key(parts):
+    # Millisecond resolution, like the cut points ffmpeg gets
+    h = hashlib.sha1()
+    for (start, end) in parts:
+        h.update(F'{start:.3f} {end:.3f}\n'.encode('ascii'))
+    return h.hexdigest()
+
+
+def measure(media_file, parts, stream_index=0):
+    # Returns (integrated loudness in LUFS, true peak in dBFS) of the parts,
+    # either can be -inf for silence
+    cache_path = cache.cache_dir('loudness')
+    key = cache.file_key(media_file, stream_index, LOUDNESS_VERSION, parts_key(parts))
+    result_path = os.path.join(cache_path, key + '.json')
+
+    try:
+        f = open(result_path, 'r', encoding='utf-8')
+        result = json.load(f)
+        f.close()
+        cache.touch(result_path)
+        return result['integrated'], result['true_peak']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    integrated, true_peak = run_ebur128(media_file, parts, stream_index)
+
+    try:
+        tmp_path = F'{result_path}.{os.getpid()}.tmp'
+        f = open(tmp_path, 'w', encoding='utf-8')
+        json.dump({'integrated': integrated, 'true_peak': true_peak}, f)
+        f.close()
+        os.replace(tmp_path, result_path)
+        cache.evict(cache_path, loudness_max_bytes, keep=(key,))
+    except OSError:
+        pass
+
+    return integrated, true_peak
+
+
+def run_ebur128(media_file, parts, stream_index=0):
+    if not parts:
+        return float('-inf'), float('-inf')
+
+    # Only the frames of the parts reach the filter, like in single pass extraction
+    conditions = '+'.join(F'gt(t+samples_n/sample_rate,{start:.3f})*lt(t,{end:.3f})' for (start, end) in parts)
+
+    with tempfile.TemporaryDirectory('iat') as tmp_path:
+        filter_path = os.path.join(tmp_path, 'filter.txt')
+        filter_f = open(filter_path, 'w')
+        filter_f.write(F'[0:a:{stream_index}]aselect=\'{conditions}\',ebur128=peak=true:framelog=quiet[out]')
+        filter_f.close()
+
+        # Nothing after the last part has to be decoded
+        stderr = ffmpeg.check_call('-loglevel', 'info', '-nostats',
+                                   '-to', F'{parts[-1][1]:.3f}',
+                                   '-i', media_file,
+                                   '-filter_complex_script', filter_path,
+                                   '-map', '[out]',
+                                   '-f', 'null', '-')
+
+    summaries = _summary_re.findall(stderr)
+    if not summaries:
+        raise ValueError(F'No loudness measured for {media_file}')
+
+    integrated, true_peak = summaries[-1]
+    return float(integrated), float(true_peak)
+
+
+def gain_db(integrated, true_peak, target_lufs=DEFAULT_TARGET_LUFS):
+    # Gain that brings the parts to target_lufs without the peaks going above MAX_TRUE_PEAK_DB
+    if integrated == float('-inf'):
+        return 0.0
+
+    gain = min(target_lufs - integrated, MAX_GAIN_DB)
+    if true_peak != float('-inf'):
+        gain = min(gain, MAX_TRUE_PEAK_DB - true_peak)
+    return round(gain, 2)
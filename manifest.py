@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import threading
+
+import cache
+
+
+MANIFEST_NAME = '.iat_manifest.json'
+
+# Options that only change how fast an output is made, not the output itself
+ignored_options = {'num_workers', 'part_workers', 'incremental', 'trace_file'}
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        h.update(chunk)
+    f.close()
+    return h.hexdigest()
+
+
+def job_digest(job, track_num, options, metadata):
+    inputs = {
+        'media_file': cache.file_key(job.media_file),
+        'subtitle_file': file_digest(job.subtitle_file) if job.subtitle_file else None,
+        'options': {k: v for (k, v) in options._asdict().items() if k not in ignored_options},
+        'album': metadata.album,
+        'album_art': cache.file_key(metadata.album_art) if metadata.album_art else None,
+        'track_num': track_num,
+    }
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+
+def combined_digest(jobs, options, metadata):
+    # A combined output depends on all jobs and their order
+    digests = [job_digest(job, track_num, options, metadata) for (track_num, job) in enumerate(jobs, 1)]
+    return hashlib.sha1(' '.join(digests).encode('utf-8')).hexdigest()
+
+
+# Converters with their own Manifest may write to the same folder at once
+# (iat_daemon runs one per job), so writes are serialized across all of them
+_record_lock = threading.Lock()
+
+
+def read_entries(dir_path):
+    try:
+        f = open(os.path.join(dir_path, MANIFEST_NAME), 'r', encoding='utf-8')
+        entries = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        return {}
+    return entries
+
+
+class Manifest:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def load(self, dir_path):
+        if dir_path not in self.entries:
+            self.entries[dir_path] = read_entries(dir_path)
+        return self.entries[dir_path]
+
+    def is_up_to_date(self, output_file, digest):
+        dir_path, file_name = os.path.split(os.path.abspath(output_file))
+        with self.lock:
+            entries = self.load(dir_path)
+        return entries.get(file_name) == digest and os.path.isfile(output_file)
+
+    def record(self, output_file, digest):
+        dir_path, file_name = os.path.split(os.path.abspath(output_file))
+        with _record_lock:
+            # Merge with what others recorded since this manifest was loaded
+            entries = read_entries(dir_path)
+            entries[file_name] = digest
+
+            manifest_path = os.path.join(dir_path, MANIFEST_NAME)
+            tmp_path = F'{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            f = open(tmp_path, 'w', encoding='utf-8')
+            json.dump(entries, f, indent=1, sort_keys=True)
+            f.close()
+            os.replace(tmp_path, manifest_path)
+
+            with self.lock:
+                self.entries[dir_path] = entries
+
+
+def tmp_output_path(output_file):
+    base, extension = os.path.splitext(output_file)
+    return base + '.iat-tmp' + extension
@@ -0,0 +1,64 @@
+import os
+import json
+import tempfile
+import numpy
+
+import cache
+import ffmpeg
+import probe
+
+
+max_bytes = 8 * 1024 * 1024 * 1024
+
+
+def load(media_file, stream_index=0):
+    cache_path = cache.cache_dir('pcm')
+    key = cache.file_key(media_file, stream_index)
+
+    pcm_path = os.path.join(cache_path, key + '.pcm')
+    info_path = os.path.join(cache_path, key + '.json')
+
+    if not (os.path.isfile(pcm_path) and os.path.isfile(info_path)):
+        decode(media_file, stream_index, pcm_path, info_path)
+        cache.evict(cache_path, max_bytes, keep=(key,))
+
+    cache.touch(pcm_path)
+    cache.touch(info_path)
+
+    info_f = open(info_path, 'r')
+    info = json.load(info_f)
+    info_f.close()
+
+    sample_rate = info['sample_rate']
+    channels = info['channels']
+
+    if os.path.getsize(pcm_path) == 0:
+        return numpy.zeros((0, channels), numpy.int16), sample_rate
+
+    samples = numpy.memmap(pcm_path, numpy.int16, 'r').reshape(-1, channels)
+    return samples, sample_rate
+
+
+def decode(media_file, stream_index, pcm_path, info_path):
+    stream = probe.audio_stream(probe.probe(media_file), stream_index) or {}
+    sample_rate = int(stream.get('sample_rate', 48000))
+    channels = int(stream.get('channels', 2))
+
+    # Decode next to the final path and rename so a cancelled run never leaves a truncated entry behind
+    fd, tmp_path = tempfile.mkstemp('.tmp', dir=os.path.dirname(pcm_path))
+    os.close(fd)
+
+    try:
+        ffmpeg.check_call('-loglevel', 'error',
+                          '-i', media_file,
+                          '-map', F'0:a:{stream_index}',
+                          '-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels),
+                          '-y', tmp_path)
+        os.replace(tmp_path, pcm_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    info_f = open(info_path, 'w')
+    json.dump({'sample_rate': sample_rate, 'channels': channels}, info_f)
+    info_f.close()
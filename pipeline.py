@@ -0,0 +1,899 @@
+import os
+import json
+import time
+from collections import namedtuple, deque
+import tempfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import subtitles
+import discovery
+import cuefilter
+import intervals
+import manifest
+import ffmpeg
+import probe
+
+
+Job = namedtuple('Job', 'media_file subtitle_file output_file')
+Options = namedtuple('Options', 'join_secs pre_pad post_pad extract_mode num_workers part_workers incremental trace_file vad_threshold_db cue_filters bitrate combine loudness_lufs', defaults=('parts', 0, 0, False, None, None, (), None, False, None))
+# Without track_numbers the outputs get no track tag, iat_daemon converts files one at a time
+Metadata = namedtuple('Metadata', 'album album_art track_numbers', defaults=(True,))
+
+# Written by the final ffmpeg pass of each job, album_art is a checked image path.
+# A combined output has no track number.
+Tags = namedtuple('Tags', 'title track_num album album_art')
+
+
+class PlanError(ValueError):
+    pass
+
+
+class NoPartsError(ValueError):
+
+    def __init__(self, media_file):
+        super(NoPartsError, self).__init__(F'No parts of {media_file} are left after filtering, nothing to extract')
+        self.media_file = media_file
+
+
+def plan_jobs(media_path, subtitle_path, output_path, audio_fallback=False, subtitle_languages=(), combine=False):
+    # With combine all jobs share output_path, Converter writes them as chapters of one file
+    if output_extension(output_path) not in output_profiles:
+        raise PlanError('Unsupported output format, use one of ' + ', '.join(output_profiles.keys()))
+
+    if combine and not output_profile(output_path).chapters:
+        raise PlanError('A combined output needs a format with chapters, use one of ' +
+                        ', '.join(e for (e, p) in output_profiles.items() if p.chapters))
+
+    dir_cache = discovery.DirCache()
+    media_matches = discovery.find_files(media_path, dir_cache)
+    media_files = [m.path for m in media_matches]
+
+    if len(media_files) < 1:
+        raise PlanError('No media input files found')
+
+
+    subtitle_files = []
+    if subtitle_path.strip() == '':
+        subtitle_index = discovery.SubtitleIndex(dir_cache, subtitle_languages)
+        for media_file in media_files:
+            subtitle_file = subtitle_index.find(media_file)
+            if subtitle_file is None and not audio_fallback:
+                raise PlanError('No subtitle file was found for\n\n' + media_file)
+            subtitle_files.append(subtitle_file)
+    else:
+        subtitle_files = [m.path for m in discovery.find_files(subtitle_path, dir_cache)]
+
+    output_files = []
+    output_num_asterisk = output_path.count('*')
+    if output_num_asterisk > 1:
+        raise PlanError('The output path is invalid')
+    elif combine:
+        if output_num_asterisk:
+            raise PlanError('A combined output is a single file, remove the * from the output path')
+        output_files = [output_path] * len(media_files)
+    elif output_num_asterisk == 1:
+        output_files = [output_path.replace('*', m.fill) for m in media_matches]
+    else:
+        output_files = [output_path]
+
+    if len(media_files) != len(subtitle_files):
+        raise PlanError('Matching media files with subtitle files failed.')
+
+    if len(media_files) != len(output_files):
+        raise PlanError('Matching media files with output files failed.')
+
+    if not combine and len(set(output_files)) != len(output_files):
+        raise PlanError('Several media files would be written to the same output file.')
+
+    return [Job(*t) for t in zip(media_files, subtitle_files, output_files)]
+
+
+# Output formats by extension. The default quality is used unless a bitrate is
+# set, tag_art and chapters tell whether the container can store album art and
+# chapters.
+OutputProfile = namedtuple('OutputProfile', 'codec default_quality part_extension tag_art chapters')
+
+output_profiles = {
+    '.mp3':  OutputProfile('libmp3lame', ('-q:a', '0'), '.mp3', True, True),
+    '.m4a':  OutputProfile('aac', ('-b:a', '64k'), '.m4a', True, True),
+    '.aac':  OutputProfile('aac', ('-b:a', '64k'), '.aac', False, False),
+    '.opus': OutputProfile('libopus', ('-b:a', '32k'), '.opus', False, True),
+    '.ogg':  OutputProfile('libopus', ('-b:a', '32k'), '.ogg', False, True),
+}
+
+# Output extensions and the source codec that can be copied into them as is
+copy_codecs = {
+    '.mp3': 'mp3',
+    '.m4a': 'aac',
+    '.aac': 'aac',
+    '.opus': 'opus',
+    '.ogg': 'opus',
+}
+
+
+def output_extension(path):
+    return os.path.splitext(path)[1].lower()
+
+
+def output_profile(path):
+    return output_profiles[output_extension(path)]
+
+
+def encoder_args(output_file, options, gain_db=None):
+    profile = output_profile(output_file)
+    quality = ('-b:a', F'{options.bitrate}k') if options.bitrate else profile.default_quality
+    return (*volume_args(gain_db), '-c:a', profile.codec, *quality)
+
+
+def volume_args(gain_db):
+    # Loudness normalization is applied by whichever ffmpeg decodes the audio for the output
+    if not gain_db:
+        return ()
+    return ('-af', F'volume={gain_db}dB')
+
+
+def encode_part(job, start, end, options, part_out_path, codec_args):
+    t = time.perf_counter()
+    ffmpeg.check_call('-loglevel', 'error',
+                      '-ss', subtitles.secs_to_strtime(start),
+                      '-i', job.media_file,
+                      '-t', subtitles.secs_to_strtime(end - start),
+                      *codec_args, '-map', 'a',
+                      part_out_path)
+    return time.perf_counter() - t
+
+
+def extract_parts(job, parts, options, tmp_path, report, tags=None, gain_db=None, codec_args=None, part_extension=None):
+    if codec_args is None:
+        codec_args = encoder_args(job.output_file, options, gain_db)
+    if part_extension is None:
+        part_extension = output_profile(job.output_file).part_extension
+
+    part_out_paths = encode_parts(job, parts, options, tmp_path, report, codec_args, part_extension)
+
+    t = time.perf_counter()
+    concat_parts(part_out_paths, tmp_path, job.output_file, tags)
+    report.stage('concat', time.perf_counter() - t)
+
+
+def encode_parts(job, parts, options, tmp_path, report, codec_args, part_extension):
+    part_out_paths = [os.path.join(tmp_path, F'part{i}{part_extension}') for i in range(len(parts))]
+
+    with ThreadPoolExecutor(options.part_workers or os.cpu_count() or 1) as executor:
+        futures = {}
+        for (i, (start, end)) in enumerate(parts):
+            future = executor.submit(encode_part, job, start, end, options, part_out_paths[i], codec_args)
+            futures[future] = i
+
+        for future in as_completed(futures):
+            secs = future.result()
+            i = futures[future]
+            report.part(i, *parts[i], secs)
+
+    return part_out_paths
+
+
+def concat_parts(part_out_paths, tmp_path, output_file, tags=None):
+    part_list_path = os.path.join(tmp_path, 'part_list.txt')
+    part_list_f = open(part_list_path, 'w')
+
+    for part_out_path in part_out_paths:
+        part_list_f.write(F'file \'{part_out_path}\'\n')
+
+    part_list_f.close()
+
+    tag_inputs, tag_outputs = tag_args(tags, output_file, 1)
+
+    ffmpeg.check_call('-loglevel', 'error',
+                      '-f', 'concat', '-safe', '0',
+                      '-i', part_list_path,
+                      *tag_inputs,
+                      '-map', '0:a',
+                      '-c', 'copy',
+                      *tag_outputs,
+                      '-y',
+                      output_file)
+
+
+def extract_single_pass(job, parts, options, tmp_path, report, tags=None, gain_db=None):
+    # Decode the source once and keep only the frames overlapping a part.
+    # Cuts are frame accurate, which the padding options easily cover.
+    conditions = []
+    for (start, end) in parts:
+        conditions.append(F'gt(t+samples_n/sample_rate,{start:.3f})*lt(t,{end:.3f})')
+
+    filter_path = os.path.join(tmp_path, 'filter.txt')
+    filter_f = open(filter_path, 'w')
+    volume = F',volume={gain_db}dB' if gain_db else ''
+    filter_f.write(F'[0:a:0]aselect=\'{"+".join(conditions)}\',asetpts=N/SR/TB{volume}[out]')
+    filter_f.close()
+
+    tag_inputs, tag_outputs = tag_args(tags, job.output_file, 1)
+
+    ffmpeg.check_call('-loglevel', 'error',
+                      '-i', job.media_file,
+                      *tag_inputs,
+                      '-filter_complex_script', filter_path,
+                      '-map', '[out]',
+                      *encoder_args(job.output_file, options),
+                      *tag_outputs,
+                      '-y',
+                      job.output_file,
+                      progress_cb=report.encoded)
+
+
+def extract_copy(job, parts, options, tmp_path, report, tags=None, gain_db=None):
+    extension = output_extension(job.output_file)
+    stream = probe.audio_stream(probe.probe(job.media_file))
+
+    # Only skip re-encoding if the output container takes the source codec
+    # and no gain has to be applied
+    if gain_db or extension not in copy_codecs or stream is None or stream.get('codec_name') != copy_codecs[extension]:
+        return extract_parts(job, parts, options, tmp_path, report, tags, gain_db)
+
+    return extract_parts(job, parts, options, tmp_path, report, tags,
+                         codec_args=('-c:a', 'copy'), part_extension=extension)
+
+
+def feed_encoder(encoder, stderr, chunks):
+    # Writes the chunks (a generator) to the stdin of a popen() encoder and
+    # waits for it, stderr is its StderrTail
+    try:
+        for data in chunks:
+            if ffmpeg.processes.cancelled:
+                raise ffmpeg.Cancelled()
+            encoder.stdin.write(data)
+        encoder.stdin.close()
+    except BrokenPipeError:
+        # The encoder quit before it got all the audio, even a clean exit is a failure
+        returncode = encoder.wait()
+        if ffmpeg.processes.cancelled:
+            raise ffmpeg.Cancelled() from None
+        raise ffmpeg.FFmpegError(returncode, stderr.text()) from None
+    except BaseException:
+        encoder.kill()
+        encoder.wait()
+        raise
+    finally:
+        chunks.close()
+
+    if encoder.wait() != 0:
+        raise ffmpeg.FFmpegError(encoder.returncode, stderr.text())
+
+
+def extract_pcm_cache(job, parts, options, tmp_path, report, tags=None, gain_db=None):
+    import pcmcache
+
+    samples, sample_rate = pcmcache.load(job.media_file)
+    channels = samples.shape[1]
+
+    tag_inputs, tag_outputs = tag_args(tags, job.output_file, 1)
+
+    proc = ffmpeg.popen('-loglevel', 'error',
+                        '-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels),
+                        '-i', 'pipe:0',
+                        *tag_inputs,
+                        '-map', '0:a',
+                        *encoder_args(job.output_file, options, gain_db),
+                        *tag_outputs,
+                        '-y',
+                        job.output_file,
+                        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = ffmpeg.StderrTail(proc.stderr)
+
+    def chunks():
+        for (i, (start, end)) in enumerate(parts):
+            t = time.perf_counter()
+            yield samples[int(start * sample_rate):int(end * sample_rate)]
+            report.part(i, start, end, time.perf_counter() - t)
+
+    feed_encoder(proc, stderr, chunks())
+
+
+def pcm_args(media_file):
+    # Raw audio format of the streaming modes, the source format if it is known
+    stream = probe.audio_stream(probe.probe(media_file)) or {}
+    return ('-f', 's16le', '-ar', str(int(stream.get('sample_rate', 48000))), '-ac', str(int(stream.get('channels', 2))))
+
+
+# Decoded audio the streaming modes hold for parts ahead of the encoder
+stream_buffer_bytes = 32 * 1024 * 1024
+STREAM_CHUNK_BYTES = 256 * 1024
+
+
+class PartBuffer:
+    # Decoded audio of the parts waiting for the encoder. Parts decoded ahead
+    # share max_bytes, the part the encoder is at only waits for the encoder.
+
+    def __init__(self, num_parts, max_bytes):
+        self.cond = threading.Condition()
+        self.chunks = [deque() for _ in range(num_parts)]
+        self.free = max_bytes
+        self.head = 0
+        self.closed = False
+
+    def put(self, i, data):
+        # Returns False once the buffer is closed
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.free >= len(data) or (i == self.head and not self.chunks[i]))
+            if self.closed:
+                return False
+            self.chunks[i].append(data)
+            self.free -= len(data)
+            self.cond.notify_all()
+            return True
+
+    def end(self, i):
+        with self.cond:
+            self.chunks[i].append(None)
+            self.cond.notify_all()
+
+    def get(self, i):
+        # Returns the next chunk of part i, None at its end
+        with self.cond:
+            self.cond.wait_for(lambda: self.chunks[i])
+            data = self.chunks[i].popleft()
+            if data is None:
+                self.head = i + 1
+            else:
+                self.free += len(data)
+            self.cond.notify_all()
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def decode_part(buffer, i, media_file, start, end, gain_db, pcm_args):
+    # Decodes part i into buffer and returns the time it took
+    t = time.perf_counter()
+    try:
+        proc = ffmpeg.popen('-loglevel', 'error',
+                            '-ss', subtitles.secs_to_strtime(start),
+                            '-i', media_file,
+                            '-t', subtitles.secs_to_strtime(end - start),
+                            '-map', 'a:0',
+                            *volume_args(gain_db),
+                            *pcm_args,
+                            'pipe:1',
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = ffmpeg.StderrTail(proc.stderr)
+
+        with proc.stdout:
+            for data in iter(lambda: proc.stdout.read(STREAM_CHUNK_BYTES), b''):
+                if not buffer.put(i, data):
+                    # Nothing reads the audio anymore
+                    proc.kill()
+                    break
+    finally:
+        buffer.end(i)
+
+    if proc.wait() != 0 and not buffer.closed:
+        if ffmpeg.processes.cancelled:
+            raise ffmpeg.Cancelled()
+        raise ffmpeg.FFmpegError(proc.returncode, stderr.text())
+    return time.perf_counter() - t
+
+
+def stream_parts(segments, pcm, output_file, options, report, tags=None, chapters_file=None):
+    # segments are (media_file, start, end, gain_db) in output order. They are
+    # decoded in parallel and piped in order into one encoder, so nothing but
+    # the output is written. The audio decoded ahead of the encoder is limited
+    # to stream_buffer_bytes, however long a segment is. pcm are the pcm_args
+    # of the stream.
+    chapter_inputs = ('-i', chapters_file) if chapters_file is not None else ()
+    chapter_outputs = ('-map_chapters', '1') if chapters_file is not None else ()
+    tag_inputs, tag_outputs = tag_args(tags, output_file, 1 + len(chapter_inputs) // 2)
+
+    encoder = ffmpeg.popen('-loglevel', 'error',
+                           *pcm,
+                           '-i', 'pipe:0',
+                           *chapter_inputs,
+                           *tag_inputs,
+                           '-map', '0:a',
+                           *encoder_args(output_file, options),
+                           *tag_outputs,
+                           *chapter_outputs,
+                           '-y',
+                           output_file,
+                           stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = ffmpeg.StderrTail(encoder.stderr)
+
+    num_workers = options.part_workers or os.cpu_count() or 1
+    ahead = 2 * num_workers
+
+    buffer = PartBuffer(len(segments), stream_buffer_bytes)
+
+    def chunks():
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = {}
+            for i in range(min(ahead, len(segments))):
+                futures[i] = executor.submit(decode_part, buffer, i, *segments[i], pcm)
+
+            try:
+                for (i, (media_file, start, end, gain_db)) in enumerate(segments):
+                    yield from iter(lambda: buffer.get(i), None)
+                    secs = futures.pop(i).result()
+                    if i + ahead < len(segments):
+                        futures[i + ahead] = executor.submit(decode_part, buffer, i + ahead, *segments[i + ahead], pcm)
+                    report.part(i, start, end, secs)
+            finally:
+                # Unblocks the decoders still running
+                buffer.close()
+                for future in futures.values():
+                    future.cancel()
+
+    feed_encoder(encoder, stderr, chunks())
+
+
+def extract_stream(job, parts, options, tmp_path, report, tags=None, gain_db=None):
+    stream_parts([(job.media_file, start, end, gain_db) for (start, end) in parts], pcm_args(job.media_file),
+                 job.output_file, options, report, tags)
+
+
+extractors = {
+    'parts': extract_parts,
+    'single_pass': extract_single_pass,
+    'copy': extract_copy,
+    'pcm_cache': extract_pcm_cache,
+    'stream': extract_stream,
+}
+
+
+# Magic bytes of the album art formats every output container takes
+album_art_magic = (
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+)
+
+
+def check_album_art(path):
+    # Returns path if it is a png or jpeg image, raises ValueError otherwise
+    if path is None:
+        return None
+
+    try:
+        f = open(path, 'rb')
+        header = f.read(8)
+        f.close()
+    except OSError as e:
+        raise ValueError(F'The album art {path} can\'t be read: {e.strerror}') from None
+
+    if not header.startswith(album_art_magic):
+        raise ValueError(F'The album art {path} is not a png or jpeg image')
+
+    return path
+
+
+def tag_args(tags, output_file, input_idx):
+    # ffmpeg arguments for the album art input (ffmpeg input number input_idx)
+    # and for the output tags, the audio has to be mapped first
+    if tags is None:
+        return (), ()
+
+    inputs = ()
+    # Only global and stream tags, a plain -1 would also drop the chapter titles
+    outputs = ['-map_metadata:g', '-1', '-map_metadata:s', '-1',
+               '-metadata', F'title={tags.title}']
+
+    if tags.track_num is not None:
+        outputs += ['-metadata', F'track={tags.track_num}']
+
+    if tags.album:
+        outputs += ['-metadata', F'album={tags.album}']
+
+    if tags.album_art is not None and output_profile(output_file).tag_art:
+        inputs = ('-i', tags.album_art)
+        # The comment makes it a front cover (APIC type 3) in mp3, some players show no other
+        outputs += ['-map', F'{input_idx}:v', '-c:v', 'copy', '-disposition:v', 'attached_pic',
+                    '-metadata:s:v', 'title=Album cover', '-metadata:s:v', 'comment=Cover (front)']
+
+    return inputs, tuple(outputs)
+
+
+def ffmetadata_escape(text):
+    return ''.join('\\' + c if c in '=;#\\\n' else c for c in text)
+
+
+def write_chapters(path, chapters):
+    # chapters are (title, start, end) in seconds, written as an ffmetadata file
+    f = open(path, 'w', encoding='utf-8')
+    f.write(';FFMETADATA1\n')
+    for (title, start, end) in chapters:
+        f.write('[CHAPTER]\nTIMEBASE=1/1000\n')
+        f.write(F'START={round(start * 1000)}\nEND={round(end * 1000)}\n')
+        f.write(F'title={ffmetadata_escape(title)}\n')
+    f.close()
+
+
+class NullReport:
+
+    def part(self, i, start, end, secs=None):
+        pass
+
+    def encoded(self, secs):
+        pass
+
+    def stage(self, name, secs):
+        pass
+
+
+class JobReport:
+    # Handed to the extractors, part() must only be called from the job's own thread
+
+    def __init__(self, converter, job_idx, num_parts, audio_secs=0):
+        self.converter = converter
+        self.job_idx = job_idx
+        self.num_parts = num_parts
+        self.audio_secs = audio_secs
+        self.num_done_parts = 0
+
+    def part(self, i, start, end, secs=None):
+        self.num_done_parts += 1
+        self.converter.emit('part', job=self.job_idx + 1, part=i + 1, done=self.num_done_parts, parts=self.num_parts,
+                            start=start, end=end, secs=secs)
+        self.converter.set_job_progress(self.job_idx, self.num_done_parts / self.num_parts)
+
+    def encoded(self, secs):
+        # Output position of an extractor that encodes all parts in one go
+        if self.audio_secs > 0:
+            self.converter.set_job_progress(self.job_idx, min(secs / self.audio_secs, 1))
+
+    def stage(self, name, secs):
+        self.converter.emit('stage', job=self.job_idx + 1, stage=name, secs=secs)
+
+
+
+class CombinedReport:
+    # Reports the parts of a combined output as parts of their own jobs
+
+    def __init__(self, converter, job_num_parts):
+        self.reports = [JobReport(converter, job_idx, n) for (job_idx, n) in enumerate(job_num_parts)]
+        self.part_jobs = [(job_idx, i) for (job_idx, n) in enumerate(job_num_parts) for i in range(n)]
+
+    def part(self, i, start, end, secs=None):
+        job_idx, job_part = self.part_jobs[i]
+        self.reports[job_idx].part(job_part, start, end, secs)
+
+    def encoded(self, secs):
+        pass
+
+    def stage(self, name, secs):
+        pass
+
+
+class Converter:
+
+    def __init__(self, jobs, options, metadata, progress_cb=None, event_cb=None):
+        self.jobs = jobs
+        self.options = options
+        self.metadata = metadata
+        self.progress_cb = progress_cb
+        self.event_cb = event_cb
+        self.errors = []
+        self.skipped = []
+        self.cancelled = []
+        self.cancel_event = threading.Event()
+        self.media_info = {}
+        self.event_lock = threading.Lock()
+        self.trace_f = None
+
+    def emit(self, event, **fields):
+        fields = {'event': event, 'time': round(time.time(), 3), **fields}
+
+        with self.event_lock:
+            if self.trace_f is not None:
+                self.trace_f.write(json.dumps(fields) + '\n')
+                self.trace_f.flush()
+
+            if self.event_cb is not None:
+                self.event_cb(fields)
+
+    def run(self):
+
+        num_jobs = len(self.jobs)
+
+        self.cue_filter = cuefilter.compile(self.options.cue_filters)
+
+        self.job_progress = [0] * num_jobs
+        self.progress_lock = threading.Lock()
+        self.errors = []
+        self.skipped = []
+        self.cancelled = []
+        self.manifest = manifest.Manifest()
+
+        ffmpeg.reset()
+        if self.cancel_event.is_set():
+            ffmpeg.cancel()
+
+        num_cpus = os.cpu_count() or 1
+        num_workers = max(min(self.options.num_workers or num_cpus, num_jobs), 1)
+
+        # Share the cores between the jobs running at the same time
+        if not self.options.part_workers:
+            self.options = self.options._replace(part_workers=max(num_cpus // num_workers, 1))
+
+        if self.options.trace_file:
+            self.trace_f = open(self.options.trace_file, 'a', encoding='utf-8')
+
+        t = time.perf_counter()
+        self.emit('batch_start', jobs=num_jobs, workers=num_workers, part_workers=self.options.part_workers)
+
+        # Read once for the batch, a broken image only costs the album art
+        try:
+            self.album_art = check_album_art(self.metadata.album_art)
+        except ValueError as e:
+            self.album_art = None
+            self.emit('warning', message=str(e))
+
+        # Cached after the first run, so this only costs time for new inputs
+        try:
+            self.media_info = probe.probe_all([job.media_file for job in self.jobs], num_cpus)
+        except ffmpeg.Cancelled:
+            self.media_info = {}
+        self.emit('probe', files=len(self.media_info), secs=time.perf_counter() - t)
+
+        if self.options.combine:
+            self.run_combined(num_workers)
+        else:
+            with ThreadPoolExecutor(num_workers) as executor:
+                futures = [executor.submit(self.convert_job, job_idx, job) for (job_idx, job) in enumerate(self.jobs)]
+                for (job_idx, future) in enumerate(futures):
+                    # A failed job must not take the rest of the batch with it
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.job_failed(job_idx, e)
+
+        self.emit('batch_end', jobs=num_jobs, skipped=len(self.skipped), failed=len(self.errors),
+                  cancelled=len(self.cancelled), secs=time.perf_counter() - t)
+
+        if self.trace_f is not None:
+            self.trace_f.close()
+            self.trace_f = None
+
+        return not self.errors and not self.cancelled
+
+    def job_failed(self, job_idx, e):
+        job = self.jobs[job_idx]
+        # Streaming ffmpeg processes just fail when they are stopped
+        if isinstance(e, ffmpeg.Cancelled) or self.cancel_event.is_set():
+            self.cancelled.append(job)
+            self.emit('job_cancelled', job=job_idx + 1, media_file=job.media_file)
+        else:
+            self.errors.append((job, e))
+            self.emit('job_failed', job=job_idx + 1, media_file=job.media_file, error=str(e))
+
+    def run_combined(self, num_workers):
+        # All jobs go into their shared output file, one chapter each, in a
+        # single streaming encode
+        output_file = self.jobs[0].output_file
+
+        if self.options.incremental:
+            digest = manifest.combined_digest(self.jobs, self.options, self.metadata)
+            if self.manifest.is_up_to_date(output_file, digest):
+                for (job_idx, job) in enumerate(self.jobs):
+                    self.skipped.append(job)
+                    self.emit('job_skipped', job=job_idx + 1, media_file=job.media_file, output_file=output_file)
+                    self.set_job_progress(job_idx, 1)
+                return
+
+        def plan_job(job_idx, job):
+            report = JobReport(self, job_idx, 0)
+            parts = self.plan_parts(job_idx, job, report)
+            return parts, self.loudness_gain(job_idx, job, parts, report)
+
+        # One missing episode would shift every chapter after it, so nothing is written then
+        job_parts = []
+        job_gains = []
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(plan_job, job_idx, job) for (job_idx, job) in enumerate(self.jobs)]
+            for (job_idx, future) in enumerate(futures):
+                try:
+                    parts, gain_db = future.result()
+                    job_parts.append(parts)
+                    job_gains.append(gain_db)
+                except Exception as e:
+                    self.job_failed(job_idx, e)
+        if self.errors or self.cancelled:
+            return
+
+        segments = []
+        chapters = []
+        audio_secs = 0
+        for (job, parts, gain_db) in zip(self.jobs, job_parts, job_gains):
+            segments += [(job.media_file, start, end, gain_db) for (start, end) in parts]
+            job_secs = sum(end - start for (start, end) in parts)
+            chapters.append((os.path.splitext(os.path.basename(job.media_file))[0], audio_secs, audio_secs + job_secs))
+            audio_secs += job_secs
+
+        # ffmpeg writes Ogg chapter times with the seconds rounded instead of
+        # truncated, whole seconds come out right with every version
+        if output_extension(output_file) in ('.opus', '.ogg'):
+            chapters = [(title, int(start), end) for (title, start, end) in chapters]
+
+        title = self.metadata.album or os.path.splitext(os.path.basename(output_file))[0]
+        tags = Tags(title, None, self.metadata.album, self.album_art)
+        report = CombinedReport(self, [len(parts) for parts in job_parts])
+
+        tmp_output_file = manifest.tmp_output_path(output_file)
+        output_dir = os.path.dirname(output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        t = time.perf_counter()
+        self.emit('combined_start', output_file=output_file, jobs=len(self.jobs), parts=len(segments), audio_secs=audio_secs)
+
+        try:
+            with tempfile.TemporaryDirectory('iat') as tmp_path:
+                chapters_file = os.path.join(tmp_path, 'chapters.txt')
+                write_chapters(chapters_file, chapters)
+                stream_parts(segments, pcm_args(self.jobs[0].media_file), tmp_output_file, self.options, report, tags, chapters_file)
+            os.replace(tmp_output_file, output_file)
+        except Exception as e:
+            # There is no output for any of the jobs
+            for job_idx in range(len(self.jobs)):
+                self.job_failed(job_idx, e)
+            return
+        finally:
+            if os.path.isfile(tmp_output_file):
+                os.remove(tmp_output_file)
+
+        if self.options.incremental:
+            self.manifest.record(output_file, digest)
+
+        secs = time.perf_counter() - t
+        self.emit('combined_end', output_file=output_file, chapters=len(chapters), secs=secs,
+                  bytes=os.path.getsize(output_file), audio_secs=audio_secs,
+                  speed=audio_secs / secs if secs > 0 else None)
+
+        for job_idx in range(len(self.jobs)):
+            self.set_job_progress(job_idx, 1)
+
+    def cancel(self):
+        # Safe to call from any thread, run() returns once the running jobs have cleaned up
+        self.cancel_event.set()
+        ffmpeg.cancel()
+
+    def track_num(self, job_idx):
+        return job_idx + 1 if self.metadata.track_numbers else None
+
+    def set_job_progress(self, job_idx, progress):
+        with self.progress_lock:
+            self.job_progress[job_idx] = progress
+            if self.progress_cb is not None:
+                self.progress_cb(sum(self.job_progress) / len(self.job_progress))
+
+    def convert_job(self, job_idx, job):
+        if self.cancel_event.is_set():
+            raise ffmpeg.Cancelled()
+
+        if self.options.incremental:
+            digest = manifest.job_digest(job, self.track_num(job_idx), self.options, self.metadata)
+            if self.manifest.is_up_to_date(job.output_file, digest):
+                self.skipped.append(job)
+                self.emit('job_skipped', job=job_idx + 1, media_file=job.media_file, output_file=job.output_file)
+                self.set_job_progress(job_idx, 1)
+                return
+
+        # Work on a temporary name so a cancelled or failed run never leaves a half written output
+        tmp_output_file = manifest.tmp_output_path(job.output_file)
+
+        # Recursive patterns mirror the media folders
+        output_dir = os.path.dirname(job.output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        t = time.perf_counter()
+        self.emit('job_start', job=job_idx + 1, media_file=job.media_file, subtitle_file=job.subtitle_file, output_file=job.output_file)
+
+        try:
+            audio_secs = self.convert_job_to(job_idx, job, tmp_output_file)
+            os.replace(tmp_output_file, job.output_file)
+        finally:
+            if os.path.isfile(tmp_output_file):
+                os.remove(tmp_output_file)
+
+        if self.options.incremental:
+            self.manifest.record(job.output_file, digest)
+
+        secs = time.perf_counter() - t
+        self.emit('job_end', job=job_idx + 1, output_file=job.output_file, secs=secs,
+                  bytes=os.path.getsize(job.output_file), audio_secs=audio_secs,
+                  speed=audio_secs / secs if secs > 0 else None)
+
+        self.set_job_progress(job_idx, 1)
+
+    def convert_job_to(self, job_idx, job, output_file):
+        report = JobReport(self, job_idx, 0)
+        parts = self.plan_parts(job_idx, job, report)
+        gain_db = self.loudness_gain(job_idx, job, parts, report)
+
+        tags = Tags(os.path.splitext(os.path.basename(job.output_file))[0], self.track_num(job_idx), self.metadata.album, self.album_art)
+
+        t = time.perf_counter()
+        with tempfile.TemporaryDirectory('iat') as tmp_path:
+            extract = extractors[self.options.extract_mode]
+            extract(job._replace(output_file=output_file), parts, self.options, tmp_path, report, tags, gain_db)
+        report.stage('extract', time.perf_counter() - t)
+
+        return report.audio_secs
+
+    def loudness_gain(self, job_idx, job, parts, report):
+        # Gain in dB that normalizes the parts, None if normalization is off
+        if self.options.loudness_lufs is None:
+            return None
+
+        import loudness
+
+        t = time.perf_counter()
+        integrated, true_peak = loudness.measure(job.media_file, parts)
+        report.stage('loudness', time.perf_counter() - t)
+
+        gain_db = loudness.gain_db(integrated, true_peak, self.options.loudness_lufs)
+        # Silence measures -inf, which JSON has no value for
+        self.emit('loudness', job=job_idx + 1, gain_db=gain_db,
+                  integrated=integrated if integrated != float('-inf') else None,
+                  true_peak=true_peak if true_peak != float('-inf') else None)
+        return gain_db
+
+    def plan_parts(self, job_idx, job, report=None):
+        # The parts of the media file to extract, from its subtitles or its audio
+        if self.cancel_event.is_set():
+            raise ffmpeg.Cancelled()
+
+        report = report or JobReport(self, job_idx, 0)
+
+        # Without probe info (no ffprobe) ffmpeg reports bad inputs itself
+        info = self.media_info.get(job.media_file)
+        if info is not None and not probe.audio_streams(info):
+            raise probe.NoAudioError(job.media_file)
+        media_secs = probe.duration(info)
+
+        def timed(name, func, *args):
+            t = time.perf_counter()
+            r = func(*args)
+            report.stage(name, time.perf_counter() - t)
+            return r
+
+        if job.subtitle_file is None:
+            # No subtitles, the parts come from the audio itself
+            import vad
+            threshold_db = self.options.vad_threshold_db
+            if threshold_db is None:
+                threshold_db = vad.DEFAULT_THRESHOLD_DB
+            starts, ends = timed('detect', vad.detect_speech, job.media_file, threshold_db)
+            num_cues = len(starts)
+        else:
+            cues = timed('parse', subtitles.parse_file, job.subtitle_file)
+            starts, ends = cues.starts, cues.ends
+            num_cues = len(cues)
+
+            if self.cue_filter:
+                starts, ends, removed = timed('filter', self.cue_filter.apply, cues)
+                self.emit('cue_filter', job=job_idx + 1, cues=num_cues, kept=len(starts), removed_secs=removed)
+
+            if self.options.vad_threshold_db is not None:
+                import vad
+                starts, ends = timed('vad', vad.trim_to_speech, job.media_file, starts, ends, self.options.vad_threshold_db)
+
+        parts = timed('merge', intervals.merge, starts, ends,
+                      self.options.join_secs, self.options.pre_pad, self.options.post_pad)
+
+        # Subtitles and padding may run past the end of the media
+        if media_secs is not None:
+            parts = [(start, min(end, media_secs)) for (start, end) in parts if start < media_secs]
+
+        report.num_parts = len(parts)
+        audio_secs = report.audio_secs = sum(end - start for (start, end) in parts)
+        self.emit('job_parts', job=job_idx + 1, cues=num_cues, parts=len(parts), audio_secs=audio_secs, media_secs=media_secs)
+
+        # The same for every extraction mode, an empty output helps nobody
+        if not parts:
+            raise NoPartsError(job.media_file)
+
+        return parts
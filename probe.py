@@ -0,0 +1,150 @@
+import os
+import json
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import ffmpeg
+
+
+# ffprobe results are cached on disk by file identity (path, size, mtime), so
+# planning a batch that was probed before does not start a single process
+
+PROBE_VERSION = 1
+probe_max_bytes = 16 * 1024 * 1024
+PROBE_EVICT_INTERVAL = 100
+
+# Recent results are kept in memory, enough for a batch. Long running
+# processes like iat_daemon probe new files forever, older ones come from disk.
+PROBE_MEMO_SIZE = 512
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+_probe_writes = 0
+
+
+class NoAudioError(ValueError):
+
+    def __init__(self, path):
+        super(NoAudioError, self).__init__(F'{path} has no audio stream')
+        self.path = path
+
+
+def probe(path):
+    # Returns the ffprobe format and streams of path, None if it can't be probed
+    try:
+        key = cache.file_key(path, PROBE_VERSION)
+    except OSError:
+        return None
+
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+
+    cache_path = os.path.join(cache.cache_dir('probe'), key + '.json')
+
+    info = load_cached(cache_path)
+    if info is None:
+        info = run_ffprobe(path)
+        if info is not None:
+            store_cached(cache_path, info)
+
+    with _memo_lock:
+        _memo[key] = info
+        while len(_memo) > PROBE_MEMO_SIZE:
+            _memo.popitem(last=False)
+    return info
+
+
+def probe_all(paths, num_workers=None):
+    # Probes all paths in parallel, returns {path: info}
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        return {}
+
+    num_workers = max(min(num_workers or os.cpu_count() or 1, len(paths)), 1)
+    with ThreadPoolExecutor(num_workers) as executor:
+        return dict(zip(paths, executor.map(probe, paths)))
+
+
+def run_ffprobe(path):
+    try:
+        proc = ffmpeg.processes.popen([ffmpeg.ffprobe_path(), '-v', 'quiet',
+                                       '-print_format', 'json',
+                                       '-show_format', '-show_streams',
+                                       path],
+                                      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output, _ = proc.communicate()
+        if proc.returncode != 0:
+            return None
+        info = json.loads(output)
+    except ffmpeg.Cancelled:
+        raise
+    except Exception:
+        return None
+
+    # Keep what the converter uses, tags and dispositions can be large
+    fmt = info.get('format', {})
+    return {
+        'format': {k: fmt[k] for k in ('format_name', 'duration', 'bit_rate') if k in fmt},
+        'streams': [{k: s[k] for k in ('index', 'codec_type', 'codec_name', 'sample_rate', 'channels', 'duration', 'bit_rate') if k in s}
+                    for s in info.get('streams', [])],
+    }
+
+
+def load_cached(cache_path):
+    try:
+        f = open(cache_path, 'r', encoding='utf-8')
+        info = json.load(f)
+        f.close()
+    except (OSError, ValueError):
+        return None
+
+    cache.touch(cache_path)
+    return info
+
+
+def store_cached(cache_path, info):
+    global _probe_writes
+
+    try:
+        tmp_path = F'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        f = open(tmp_path, 'w', encoding='utf-8')
+        json.dump(info, f)
+        f.close()
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        return
+
+    with _memo_lock:
+        _probe_writes += 1
+        evict = _probe_writes % PROBE_EVICT_INTERVAL == 1
+
+    if evict:
+        cache.evict(os.path.dirname(cache_path), probe_max_bytes)
+
+
+def audio_streams(info):
+    if info is None:
+        return []
+    return [s for s in info['streams'] if s.get('codec_type') == 'audio']
+
+
+def audio_stream(info, stream_index=0):
+    streams = audio_streams(info)
+    if stream_index >= len(streams):
+        return None
+    return streams[stream_index]
+
+
+def duration(info):
+    # Container duration in seconds, None if unknown
+    if info is None:
+        return None
+    try:
+        return float(info['format']['duration'])
+    except (KeyError, ValueError):
+        return None
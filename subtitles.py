@@ -1,7 +1,16 @@
 import os
+import re
+import sys
+import struct
+import threading
+from array import array
+
+import cache
 
 
 class Subtitle:
+    __slots__ = ('start', 'end', 'text')
+
     def __init__(self, start=None, end=None, text=None):
         self.start = start
         self.end = end
@@ -42,7 +51,134 @@ def secs_to_strtime(secs):
 
 # Subtitle parsing
 
-def parse_file(path):
+_time_pattern = rb'(?:(\d+):)?(\d+):(\d+)[.,](\d+)'
+
+# Time line and the non blank text lines after it, the index line is not needed
+_srt_cue_re = re.compile(rb'^[ \t]*' + _time_pattern + rb'[ \t]*-->[ \t]*' + _time_pattern + rb'[^\n]*\n((?:[ \t\r]*\S[^\n]*(?:\n|$))+)', re.M)
+
+# Section headers and Layer,Start,End,Style,Name,MarginL,MarginR,MarginV,Effect,Text dialogue lines
+_ass_line_re = re.compile(rb'^(?:\[([^\]\n]*)\][ \t\r]*$|Dialogue:[ \t]*([^,\n]*),[ \t]*' + _time_pattern + rb'[ \t]*,[ \t]*' + _time_pattern + rb'[ \t]*,([^,\n]*),[^,\n]*,(?:[^,\n]*,){3}([^,\n]*),([^\n]*))', re.M)
+
+_blank_line_re = re.compile(rb'\n[ \t\r]*\n')
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+_frac_scales = [10.0 ** -i for i in range(16)]
+
+
+def groups_to_secs(hrs, mins, secs, frac):
+    return (int(hrs or 0) * 60 + int(mins)) * 60 + int(secs) + int(frac) * _frac_scales[len(frac)]
+
+
+def read_chunks(path, split_at_blank_line=False):
+    # Yields (file offset, data) chunks that end on a line boundary, or a blank line if requested
+    f = open(path, 'rb')
+
+    offset = 0
+    rest = b''
+
+    while True:
+        data = f.read(READ_BUFFER_SIZE)
+        buf = rest + data if rest else data
+
+        if not data:
+            if buf:
+                yield offset, buf
+            break
+
+        if split_at_blank_line:
+            split = -1
+            for m in _blank_line_re.finditer(buf, max(len(buf) - READ_BUFFER_SIZE // 4, 0)):
+                split = m.end()
+            if split < 0:
+                # None near the end, the last one anywhere. Without any the data is read on.
+                for m in _blank_line_re.finditer(buf):
+                    split = m.end()
+        else:
+            split = buf.rfind(b'\n') + 1
+
+        if split <= 0:
+            rest = buf
+            continue
+
+        yield offset, buf[:split]
+        offset += split
+        rest = buf[split:]
+
+    f.close()
+
+
+class CueStore:
+    # Cue times are kept in flat arrays, the text is only read from the file when needed.
+    # The ass style and effect names are stored once in names and referenced by index.
+
+    def __init__(self, path=None, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        self.starts = array('d')
+        self.ends = array('d')
+        self.text_offsets = array('q')
+        self.layers = array('i')
+        self.style_ids = array('i')
+        self.effect_ids = array('i')
+        self.names = ['']
+        self.name_ids = {'': 0}
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        f = open(self.path, 'rb') if self.path is not None else None
+        for i in range(len(self)):
+            yield Subtitle(self.starts[i], self.ends[i], self.read_text(f, i))
+        if f is not None:
+            f.close()
+
+    def append(self, start, end, text_begin, text_end, layer=0, style='', effect=''):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.text_offsets.extend((text_begin, text_end))
+        self.layers.append(layer)
+        self.style_ids.append(self.name_id(style))
+        self.effect_ids.append(self.name_id(effect))
+
+    def name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def style(self, i):
+        return self.names[self.style_ids[i]]
+
+    def effect(self, i):
+        return self.names[self.effect_ids[i]]
+
+    def texts(self):
+        f = open(self.path, 'rb')
+        texts = [self.read_text(f, i) for i in range(len(self))]
+        f.close()
+        return texts
+
+    def text(self, i):
+        f = open(self.path, 'rb')
+        text = self.read_text(f, i)
+        f.close()
+        return text
+
+    def read_text(self, f, i):
+        if f is None:
+            return None
+        text_begin = self.text_offsets[2*i]
+        text_end = self.text_offsets[2*i+1]
+        f.seek(text_begin)
+        text = f.read(text_end - text_begin).decode(self.encoding, 'replace')
+        return '\n'.join(l.rstrip() for l in text.splitlines())
+
+
+def parse_file(path, use_cache=True):
     extension_i = path.rfind('.')
     if extension_i < 0:
         raise ValueError('Unknown Format')
@@ -50,51 +186,127 @@ def parse_file(path):
     parser = parsers.get(extension)
     if parser is None:
         raise ValueError('Unknown Format')
-    return parser(path)
 
+    if not use_cache:
+        return parser(path)
 
-def parse_file_srt(path):
-    f = open(path, 'r', encoding='utf-8')
-
-    lines = []
-    for l in f:
-        l = l.rstrip()
-        lines.append(l)
-        if l == '':
-            if len(lines) >= 4:
-                time_parts = lines[1].split(' --> ')
-                if len(time_parts) == 2:
-                    text = '\n'.join(lines[2:-1])
-                    start = strtime_to_secs(time_parts[0])
-                    end = strtime_to_secs(time_parts[1])
-                    yield Subtitle(start, end, text)
-            lines = []
+    cues = load_cached(path)
+    if cues is None:
+        cues = parser(path)
+        store_cached(path, cues)
+    return cues
 
-    f.close()
 
 
-def parse_file_ass(path):
-    f = open(path, 'r', encoding='utf-8')
+# Parsed cue cache
+#
+# Entries are keyed by path, size and mtime, so a changed file is never served
+# from the cache. An entry holds a header, the raw cue arrays and the names.
 
-    in_events = False
-    for l in f:
-            l = l.rstrip()
+CACHE_MAGIC = b'IATC'
+CACHE_VERSION = 2
+_cache_header = struct.Struct('<4sIQ')
 
-            if l.startswith('[') and l.endswith(']'):
-                in_events = l[1:-1] == 'Events'
+cache_max_bytes = 256 * 1024 * 1024
+CACHE_EVICT_INTERVAL = 100
 
-            elif in_events and l.startswith('Dialogue: '):
-                l_parts = l[len('Dialogue: '):].split(',')
+_cache_lock = threading.Lock()
+_cache_writes = 0
 
-                if len(l_parts) < 10:
-                    continue
 
-                text = ','.join(l_parts[9:])
-                start = strtime_to_secs(l_parts[1])
-                end = strtime_to_secs(l_parts[2])
-                yield Subtitle(start, end, text)
+def cache_path_for(path):
+    key = cache.file_key(path, CACHE_VERSION, sys.byteorder)
+    return os.path.join(cache.cache_dir('subtitles'), key + '.cues')
 
-    f.close()
+
+def load_cached(path):
+    try:
+        cache_path = cache_path_for(path)
+        f = open(cache_path, 'rb')
+    except OSError:
+        return None
+
+    try:
+        magic, version, count = _cache_header.unpack(f.read(_cache_header.size))
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        cues = CueStore(path)
+        cues.starts.fromfile(f, count)
+        cues.ends.fromfile(f, count)
+        cues.text_offsets.fromfile(f, 2 * count)
+        cues.layers.fromfile(f, count)
+        cues.style_ids.fromfile(f, count)
+        cues.effect_ids.fromfile(f, count)
+        cues.names = f.read().decode('utf-8').split('\0')
+        cues.name_ids = {name: i for (i, name) in enumerate(cues.names)}
+    except (struct.error, EOFError, OSError, UnicodeDecodeError):
+        return None
+    finally:
+        f.close()
+
+    cache.touch(cache_path)
+    return cues
+
+
+def store_cached(path, cues):
+    global _cache_writes
+
+    try:
+        cache_path = cache_path_for(path)
+        tmp_path = F'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        f = open(tmp_path, 'wb')
+        f.write(_cache_header.pack(CACHE_MAGIC, CACHE_VERSION, len(cues)))
+        cues.starts.tofile(f)
+        cues.ends.tofile(f)
+        cues.text_offsets.tofile(f)
+        cues.layers.tofile(f)
+        cues.style_ids.tofile(f)
+        cues.effect_ids.tofile(f)
+        f.write('\0'.join(cues.names).encode('utf-8'))
+        f.close()
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        return
+
+    # Scanning the cache dir on every write would be slow for large batches
+    with _cache_lock:
+        _cache_writes += 1
+        evict = _cache_writes % CACHE_EVICT_INTERVAL == 1
+
+    if evict:
+        cache.evict(os.path.dirname(cache_path), cache_max_bytes)
+
+
+def parse_file_srt(path):
+    cues = CueStore(path)
+    append = cues.append
+
+    for (offset, buf) in read_chunks(path, True):
+        for m in _srt_cue_re.finditer(buf):
+            h1, m1, s1, f1, h2, m2, s2, f2, text = m.groups()
+            text_begin = offset + m.start(9)
+            append(groups_to_secs(h1, m1, s1, f1), groups_to_secs(h2, m2, s2, f2), text_begin, text_begin + len(text.rstrip()))
+
+    return cues
+
+
+def parse_file_ass(path):
+    cues = CueStore(path)
+    append = cues.append
+
+    in_events = False
+    for (offset, buf) in read_chunks(path):
+        for m in _ass_line_re.finditer(buf):
+            section, layer, h1, m1, s1, f1, h2, m2, s2, f2, style, effect, text = m.groups()
+            if section is not None:
+                in_events = section == b'Events'
+            elif in_events:
+                text_begin = offset + m.start(13)
+                layer = int(layer) if layer.strip().isdigit() else 0
+                append(groups_to_secs(h1, m1, s1, f1), groups_to_secs(h2, m2, s2, f2), text_begin, text_begin + len(text.rstrip()),
+                       layer, style.strip().decode(cues.encoding, 'replace'), effect.strip().decode(cues.encoding, 'replace'))
+
+    return cues
 
 
 parsers = {
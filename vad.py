@@ -0,0 +1,178 @@
+import os
+import subprocess
+from array import array
+import numpy
+
+import cache
+import ffmpeg
+
+
+SAMPLE_RATE = 16000
+FRAME_SECS = 0.02
+FRAME_LEN = int(SAMPLE_RATE * FRAME_SECS)
+
+# Frames per read from ffmpeg, 10 seconds
+CHUNK_FRAMES = 500
+
+# Only look at the frequencies speech is made of, this keeps rumble and hiss out of the levels
+SPEECH_FILTER = 'highpass=f=200,lowpass=f=3500'
+
+# Parts need at least this many speech frames to be kept
+MIN_SPEECH_FRAMES = 3
+
+# Speech detection without subtitles bridges pauses shorter than this
+DETECT_MIN_GAP_SECS = 0.3
+DEFAULT_THRESHOLD_DB = -30.0
+
+# Frames at or below this level are never speech, digital silence is at -90 dBFS
+SPEECH_FLOOR_DB = -60.0
+
+LEVELS_VERSION = 1
+levels_max_bytes = 256 * 1024 * 1024
+
+
+def iter_frame_levels(media_file, stream_index=0):
+    # Yields arrays of frame levels in dBFS while ffmpeg decodes, memory use does not depend on the input length
+    proc = ffmpeg.popen('-loglevel', 'panic',
+                        '-i', media_file,
+                        '-map', F'0:a:{stream_index}',
+                        '-af', SPEECH_FILTER,
+                        '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE),
+                        'pipe:1',
+                        stdout=subprocess.PIPE)
+
+    chunk_bytes = CHUNK_FRAMES * FRAME_LEN * 2
+
+    try:
+        while True:
+            data = proc.stdout.read(chunk_bytes)
+
+            samples = numpy.frombuffer(data, numpy.int16)
+            num_frames = len(samples) // FRAME_LEN
+            if num_frames == 0:
+                break
+
+            frames = samples[:num_frames * FRAME_LEN].reshape(num_frames, FRAME_LEN).astype(numpy.float32)
+            rms = numpy.sqrt(numpy.mean(frames * frames, axis=1))
+            yield 20 * numpy.log10(numpy.maximum(rms, 1) / 32768)
+
+        if proc.wait() != 0:
+            raise ffmpeg.FFmpegError(proc.returncode)
+    finally:
+        # Also reached when the caller stops early
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+
+def frame_levels(media_file, stream_index=0):
+    cache_path = cache.cache_dir('levels')
+    key = cache.file_key(media_file, stream_index, LEVELS_VERSION, SAMPLE_RATE, FRAME_SECS)
+    levels_path = os.path.join(cache_path, key + '.npy')
+
+    try:
+        levels = numpy.load(levels_path)
+        cache.touch(levels_path)
+        return levels
+    except (OSError, ValueError):
+        pass
+
+    chunks = list(iter_frame_levels(media_file, stream_index))
+    levels = numpy.concatenate(chunks) if chunks else numpy.zeros(0, numpy.float32)
+
+    try:
+        tmp_path = F'{levels_path}.{os.getpid()}.tmp.npy'
+        numpy.save(tmp_path, levels)
+        os.replace(tmp_path, levels_path)
+        cache.evict(cache_path, levels_max_bytes, keep=(key,))
+    except OSError:
+        pass
+
+    return levels
+
+
+def speech_threshold(levels, threshold_db):
+    # Relative to the loud end of the file so the setting works for quiet and loud sources alike
+    if len(levels) == 0:
+        return 0
+    return numpy.percentile(levels, 95) + threshold_db
+
+
+def trim(starts, ends, levels, threshold):
+    # Shrinks every interval to its first and last speech frame and drops the ones without speech
+    starts = numpy.asarray(starts, numpy.float64)
+    ends = numpy.asarray(ends, numpy.float64)
+
+    num_frames = len(levels)
+    voiced = levels > threshold
+    idxs = numpy.arange(num_frames)
+
+    # Nearest speech frame at or after / at or before every frame
+    next_voiced = numpy.where(voiced, idxs, num_frames)
+    next_voiced = numpy.minimum.accumulate(next_voiced[::-1])[::-1]
+    prev_voiced = numpy.where(voiced, idxs, -1)
+    prev_voiced = numpy.maximum.accumulate(prev_voiced)
+
+    voiced_count = numpy.concatenate(([0], numpy.cumsum(voiced)))
+
+    first_frames = numpy.clip((starts / FRAME_SECS).astype(numpy.int64), 0, num_frames)
+    end_frames = numpy.clip(numpy.ceil(ends / FRAME_SECS).astype(numpy.int64), 0, num_frames)
+
+    keep = voiced_count[end_frames] - voiced_count[first_frames] >= MIN_SPEECH_FRAMES
+    first_frames = first_frames[keep]
+    end_frames = end_frames[keep]
+
+    new_starts = numpy.maximum(next_voiced[first_frames] * FRAME_SECS, starts[keep])
+    new_ends = numpy.minimum((prev_voiced[end_frames - 1] + 1) * FRAME_SECS, ends[keep])
+
+    return new_starts, new_ends
+
+
+def trim_to_speech(media_file, starts, ends, threshold_db):
+    levels = frame_levels(media_file)
+    return trim(starts, ends, levels, speech_threshold(levels, threshold_db))
+
+
+def detect_speech(media_file, threshold_db=DEFAULT_THRESHOLD_DB, stream_index=0):
+    # Builds speech intervals straight from the audio, chunk by chunk, so only
+    # the found intervals are kept in memory. The whole file can't be looked at
+    # up front, so the threshold follows the loudest chunk seen so far. The
+    # floor keeps a quiet start from becoming its own reference.
+    starts = array('d')
+    ends = array('d')
+
+    min_gap_frames = int(DETECT_MIN_GAP_SECS / FRAME_SECS)
+
+    reference = None
+    frame_offset = 0
+    run_start = run_end = None
+
+    def flush():
+        if run_start is not None and run_end - run_start >= MIN_SPEECH_FRAMES:
+            starts.append(run_start * FRAME_SECS)
+            ends.append(run_end * FRAME_SECS)
+
+    for levels in iter_frame_levels(media_file, stream_index):
+        chunk_reference = numpy.percentile(levels, 95)
+        reference = chunk_reference if reference is None else max(reference, chunk_reference)
+
+        threshold = max(reference + threshold_db, SPEECH_FLOOR_DB)
+
+        voiced = numpy.concatenate(([False], levels > threshold, [False]))
+        edges = numpy.diff(voiced.astype(numpy.int8))
+
+        for (s, e) in zip(numpy.flatnonzero(edges == 1).tolist(), numpy.flatnonzero(edges == -1).tolist()):
+            s += frame_offset
+            e += frame_offset
+            if run_start is not None and s - run_end <= min_gap_frames:
+                run_end = e
+            else:
+                flush()
+                run_start, run_end = s, e
+
+        frame_offset += len(levels)
+
+    flush()
+
+    return starts, ends